@@ -0,0 +1,171 @@
+import argparse
+import csv
+import importlib.util
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+"""
+
+Benchmark "ups configuration sanitized.py" against a fleet of fake NMC2 cards from "ups simulator.py".
+
+Starts the requested number of fake UPSes on loopback addresses, writes a ups_list_rerun.csv for them in an empty working folder and runs the
+configuration script's main() against it. Afterwards the fleet throughput, the p50/p95/max of every step (from ups_timing_report.json) and
+how many logins, commands and reboots each fake UPS saw are printed and saved to ups_benchmark.json in the working folder.
+
+With --rerun the script is run a second time against the now configured fleet, which shows what a rerun over a compliant fleet costs. With
+--config-ini both passes push the settings as a config.ini instead of CLI commands. --dead-units adds addresses to the inventory that nothing
+listens on, to see what the preflight check costs. --audit finishes with a read-only audit pass over the fleet and times a compliance query
+on the ups_audit.sqlite it wrote. --rotate adds a pass of the rotate subcommand, which only rotates the password to a new one, like a quarterly rotation. --per-site is handed on to the configuration script, the fake UPSes are spread over four sites.
+--drop-chance has the fake UPSes drop the connection on that share of the commands (seeded, so runs can be compared), to see what retrying
+the failed UPSes at the end of a run costs. The script's --retry-delay is set to --retry-delay here, 1 second by default.
+
+The passwords and secrets are taken from the same environment variables the configuration script uses, made up values are used for the ones
+that are not set.
+
+"""
+
+scriptFolder = Path(__file__).resolve().parent
+
+def loadScript(fileName, moduleName):
+    spec = importlib.util.spec_from_file_location(moduleName, scriptFolder / fileName)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def runPass(upsConfiguration, fleet, command, workers, extraArguments, summaryFile='ups_summary.csv'):
+    """
+    Run a subcommand of the configuration script once against the fleet and return what it measured
+    """
+    for nmc in fleet:
+        nmc.logins = nmc.failedLogins = nmc.commands = nmc.reboots = nmc.radiusRequests = nmc.configIniUploads = nmc.droppedConnections = 0
+    with upsConfiguration.timingsLock:
+        upsConfiguration.timings.clear()
+
+    started = time.monotonic()
+    upsConfiguration.main([command, '--workers', str(workers)] + extraArguments)
+    elapsed = time.monotonic() - started
+
+    with open(summaryFile) as csvfile:
+        results = list(csv.DictReader(csvfile))
+    with open('ups_timing_report.json') as file:
+        timingReport = json.load(file)
+    return {
+        'units': len(fleet),
+        'workers': workers,
+        'elapsed': round(elapsed, 2),
+        'unitsPerMinute': round(len(fleet) * 60 / elapsed, 2) if elapsed > 0 else None,
+        'succeeded': sum(1 for result in results if result['status'] == 'success'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'leftOut': sum(1 for result in results if result['detail'].startswith('preflight')),
+        'loginsPerUnit': round(sum(nmc.logins for nmc in fleet) / len(fleet), 2),
+        'commandsPerUnit': round(sum(nmc.commands for nmc in fleet) / len(fleet), 2),
+        'reboots': sum(nmc.reboots for nmc in fleet),
+        'configIniUploads': sum(nmc.configIniUploads for nmc in fleet),
+        'droppedConnections': sum(nmc.droppedConnections for nmc in fleet),
+        'retried': sum(1 for result in results if int(result.get('attempts') or 1) > 1),
+        'failureClasses': dict((name, sum(1 for result in results if result['status'] == 'failed' and result.get('failureClass') == name))
+            for name in set(result.get('failureClass') for result in results if result['status'] == 'failed')),
+        'idleSeconds': timingReport['idleSeconds'],
+        'activeSeconds': timingReport['activeSeconds'],
+        'stats': timingReport['stats'],
+    }
+
+def printPass(name, measured):
+    print("\n" + name + ": " + str(measured['units']) + " UPSes with " + str(measured['workers']) + " workers in " + str(measured['elapsed'])
+        + " seconds (" + str(measured['unitsPerMinute']) + " UPSes per minute), " + str(measured['succeeded']) + " succeeded, "
+        + str(measured['failed']) + " failed (" + str(measured['leftOut']) + " left out by the preflight check)")
+    print("  " + str(measured['droppedConnections']) + " dropped connections, " + str(measured['retried']) + " UPSes retried, failures by class: "
+        + (", ".join(str(count) + " " + name for name, count in sorted(measured['failureClasses'].items())) or "none"))
+    print("  " + str(measured['loginsPerUnit']) + " logins and " + str(measured['commandsPerUnit']) + " commands per UPS, "
+        + str(measured['reboots']) + " reboots, " + str(measured['configIniUploads']) + " config.ini uploads, " + str(measured['activeSeconds']) + " seconds working and " + str(measured['idleSeconds'])
+        + " seconds waiting on reboots")
+    print("  %-9s %-26s %7s %9s %9s %9s" % ('category', 'name', 'count', 'p50', 'p95', 'max'))
+    for stat in measured['stats']:
+        if stat['category'] in ('stage', 'connect', 'wait'):
+            print("  %-9s %-26s %7d %9.2f %9.2f %9.2f" % (stat['category'], stat['name'], stat['count'], stat['p50'], stat['p95'], stat['max']))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the UPS configuration script against fake NMC2 cards")
+    parser.add_argument('--units', type=int, default=20, help="number of fake UPSes")
+    parser.add_argument('--workers', type=int, default=8, help="number of UPSes the script configures at the same time")
+    parser.add_argument('--first-address', default="127.0.1.1", help="loopback address of the first fake UPS")
+    parser.add_argument('--port', type=int, default=2222, help="SSH port every fake UPS listens on")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds every command takes")
+    parser.add_argument('--login-latency', type=float, default=0.3, help="seconds every login takes")
+    parser.add_argument('--reboot-seconds', type=float, default=5.0, help="seconds a reboot takes")
+    parser.add_argument('--dead-units', type=int, default=0, help="number of inventory addresses without a UPS behind them")
+    parser.add_argument('--rerun', action='store_true', help="run a second time against the configured fleet")
+    parser.add_argument('--per-site', type=int, help="number of UPSes of one site the script works on at the same time")
+    parser.add_argument('--rotate', action='store_true', help="add a pass that only rotates the password")
+    parser.add_argument('--audit', action='store_true', help="finish with a read-only audit pass")
+    parser.add_argument('--config-ini', action='store_true', help="have the script upload a config.ini instead of sending CLI commands")
+    parser.add_argument('--drop-chance', type=float, default=0.0, help="chance that a fake UPS drops the connection instead of answering a command")
+    parser.add_argument('--seed', type=int, default=1, help="seed for the dropped connections")
+    parser.add_argument('--retry-delay', type=float, default=1.0, help="seconds the script waits before retrying failed UPSes")
+    parser.add_argument('--output', help="working folder for the inventory, logs and reports, a new temporary folder by default")
+    args = parser.parse_args()
+
+    for variable, value in [('upsStandardPassword', 'benchmarkStandard'), ('upsNewPassword', 'benchmarkNew'), ('upsSNMPv3auth', 'benchmarkAuth'),
+            ('upsSNMPv3priv', 'benchmarkPriv'), ('radiusSecret', 'benchmarkSecret'), ('upsServicePassword', 'benchmarkService')]:
+        os.environ.setdefault(variable, value)
+
+    simulator = loadScript("ups simulator.py", "ups_simulator")
+    upsConfiguration = loadScript("ups configuration sanitized.py", "ups_configuration")
+    upsConfiguration.sshPort = args.port
+
+    output = Path(args.output) if args.output else Path(tempfile.mkdtemp(prefix='ups_benchmark_'))
+    output.mkdir(parents=True, exist_ok=True)
+    os.chdir(output)
+
+    simulator.getHostKey()
+    fleet = simulator.startFleet(args.units, args.first_address, args.port, serviceUsername=upsConfiguration.serviceUsername,
+        servicePassword=upsConfiguration.servicePassword, radiusSecret=upsConfiguration.radiusSecret, latency=args.latency,
+        loginLatency=args.login_latency, rebootSeconds=args.reboot_seconds, dropChance=args.drop_chance, seed=args.seed)
+    with open('ups_list_rerun.csv', 'w', newline='') as csvfile:
+        inventory = csv.writer(csvfile)
+        inventory.writerow(['IP', 'sysName', 'sysLocation'])
+        for number, nmc in enumerate(fleet):
+            inventory.writerow([nmc.address, 'ups%04d' % (number + 1), 'Benchmark Site ' + str(number % 4 + 1)])
+        # The addresses after the fleet's, where nothing listens
+        for number in range(args.units, args.units + args.dead_units):
+            inventory.writerow([simulator.loopbackAddress(args.first_address, number), 'dead%04d' % (number + 1), 'Benchmark Site ' + str(number % 4 + 1)])
+
+    extraArguments = (['--config-ini'] if args.config_ini else []) + (['--per-site', str(args.per_site)] if args.per_site else []) + ['--retry-delay',
+        str(args.retry_delay)]
+    benchmark = {'firstPass': runPass(upsConfiguration, fleet, 'rollout', args.workers, extraArguments)}
+    if args.rerun:
+        benchmark['rerun'] = runPass(upsConfiguration, fleet, 'rollout', args.workers, extraArguments)
+    if args.rotate:
+        # The fleet is on the new standard password now, which becomes the current one for the next rotation
+        upsConfiguration.standardPassword = upsConfiguration.newPassword
+        upsConfiguration.newPassword = upsConfiguration.newPassword + 'Rotated'
+        benchmark['rotation'] = runPass(upsConfiguration, fleet, 'rotate', args.workers, ['--retry-delay', str(args.retry_delay)], 'ups_rotation_report.csv')
+    if args.audit:
+        benchmark['audit'] = runPass(upsConfiguration, fleet, 'audit', args.workers, ['--retry-delay', str(args.retry_delay)], 'ups_audit_summary.csv')
+        connection = sqlite3.connect('ups_audit.sqlite')
+        started = time.monotonic()
+        connection.execute("SELECT section, name, count(*) FROM differences GROUP BY section, name").fetchall()
+        connection.execute("SELECT count(*) FROM units WHERE status != 'compliant'").fetchone()
+        benchmark['audit']['querySeconds'] = round(time.monotonic() - started, 4)
+        connection.close()
+    for nmc in fleet:
+        nmc.stop()
+
+    printPass("First pass", benchmark['firstPass'])
+    if args.rerun:
+        printPass("Rerun", benchmark['rerun'])
+    if args.rotate:
+        printPass("Rotation", benchmark['rotation'])
+    if args.audit:
+        printPass("Audit", benchmark['audit'])
+        print("  Compliance queries on ups_audit.sqlite took " + str(benchmark['audit']['querySeconds']) + " seconds")
+    with open('ups_benchmark.json', 'w') as file:
+        json.dump(benchmark, file, indent=2)
+    print("\nLogs and reports are in " + str(output))
+
+if __name__ == "__main__":
+    main()
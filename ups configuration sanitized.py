@@ -1,34 +1,52 @@
-from email.policy import default
 #from typing_extensions import ParamSpecKwargs
-from netmiko import Netmiko
-import paramiko
-from getpass import getpass
 import datetime
-import pexpect
-import pexpect.popen_spawn
-import wexpect
 import os
 import csv
 import time
 import re
 from pathlib import Path
 import sys
+import argparse
+import functools
+import math
+import queue
+import random
+import json
+import io
+import ipaddress
+import zlib
+import sqlite3
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 """
 
-Set the following Windows environment variables prior to running:
+Run the script with one of these subcommands:
 
-upsStandardPassword
-upsNewPassword
-upsSNMPv3auth
-upsSNMPv3priv
-radiusSecret
+rollout     configure every UPS in the list (what the script does when no subcommand is given)
+rotate      only change the apc password of every UPS
+audit       only read the configuration of every UPS and store how it differs from the wanted settings
+preflight   only check which UPSes answer on their SSH port as an NMC2
 
+"ups configuration sanitized.py <subcommand> --help" lists the options of a subcommand. Only what a subcommand needs is loaded: preflight does not
+load netmiko or paramiko at all and rotate only loads paramiko, so the quick subcommands start quickly. The functions of the script can also be
+used from other scripts, importing it does not load any SSH library, ask for anything or start a run.
 
-You can set the desired values in your OS's environment variables to keep them out of the script.
+Set the following environment variables prior to running (Windows or Linux):
 
-Alternatively, you can comment out the section where the variables are set by getting the OS environment variables and instead use the section below it to
-prompt for each of the values.
+upsStandardPassword     (rollout, rotate)
+upsNewPassword          (rollout, rotate)
+upsSNMPv3auth           (rollout)
+upsSNMPv3priv           (rollout)
+radiusSecret            (rollout)
+upsServicePassword      (rollout, audit)
+
+
+You can set the desired values in your OS's environment variables to keep them out of the script. The ones that are not set are read from a
+secrets file given with --secrets-file (or the upsSecretsFile environment variable), with one VARIABLE=value line per secret, for example
+upsNewPassword=ABCDEF. Lines starting with # are skipped. Nothing is prompted for, so the script can be run from a scheduler without a console;
+a subcommand that is missing a secret it needs stops before it connects to anything and names the missing variables.
 
 
 Once this script is run against all the UPSes (and assuming it was successful) the value for upsStandardPassword should be changed to match the value
@@ -39,267 +57,1148 @@ If the password is being rotated to "ABCDEF" then the value of upsNewPassword sh
 Once the script is run, the value of upsStandardPassword should be set to "ABCDEF" making both variables the same value. Then the next time the password
 is to be rotated, upsNewPassword is set to the new password and this script is run.
 
+To only rotate the password, run the script with the rotate subcommand. Nothing but the password of the apc account is touched: each UPS is logged in to once,
+the password it is on is found out on that connection and changed to upsNewPassword, and then a login with upsNewPassword is tried to prove it
+took. ups_rotation_report.csv lists for every UPS which password it was on (default, current standard, new standard or unknown), which one it is
+on now and how it went. The passwords themselves are never written anywhere.
+
 This script is intended to be run against APC Smart-UPS units with a Network Management Card 2 installed that have either been factory reset or are brand new. 
 These commands may work against other models of APC UPS or even PDUs, but this script specifically was not written for them. If you want to do the same things 
 in this script to a different APC platform, you should copy this script to a new script and make the necessary modifications for the target platform. Since 
 this script is only being tested against the Smart-UPS platform with an NMC2 module installed, I cannot guarantee its functionality on any other platform. 
 
+Several UPSes are configured at the same time. The number of UPSes worked on at once can be set with --workers (or the upsWorkers environment variable),
+the default is 8. Console lines are prefixed with the UPS they belong to, each UPS also gets its own log file in the ups_logs folder, and a summary of
+every UPS is printed and written to ups_summary.csv once the run finishes. Everything is also written to ups_log.jsonl, one JSON record per line with
+the UPS IP, sysName, step, event, duration and error class, so a run can be searched afterwards.
+
+The current configuration of each UPS is read once and only the settings that differ from the wanted settings are sent. Rerunning the script against a
+UPS that is already configured does not change anything and does not reboot it.
+
+Every step finished for a UPS is written to ups_journal.jsonl. If a run is interrupted or some UPSes fail, run the script again with --resume and each
+UPS picks up at the first step it did not finish, UPSes that finished every step are skipped.
+
+Before anything is configured every UPS in the list is checked at the same time: its SSH port is connected to and the SSH banner tells an NMC2 apart
+from other devices. UPSes that do not answer, or answer as something other than an NMC2, are left out of the run and marked as failed in the summary,
+UPSes whose SSH port answers without a banner (usually a card that is still booting) are configured last. The result of the check for every UPS is
+written to ups_preflight.csv, UPSes that are retried get a line for every attempt. Use --skip-preflight to leave the check out, or the preflight subcommand to only run the check.
+
+The UPS list is read one row at a time, so lists with tens of thousands of UPSes do not have to fit in memory. It is ups_list_rerun.csv unless
+another file is given with --inventory, either a CSV file with a header row or a .jsonl file with one JSON object per line. The columns are found by
+name (IP, sysName and sysLocation; upsIP, name and location work too), a CSV file without those names in its header is read by position like before.
+Rows without a valid IP, sysName or sysLocation are skipped and logged, and only the first row for an IP is used. To split a large fleet over
+several machines or processes, run each one with --shard 1/4, --shard 2/4 and so on: every IP belongs to exactly one shard, the same one on
+every machine. --site only configures the UPSes whose sysLocation matches, it can be given more than once.
+
+With the audit subcommand nothing is changed: every UPS is logged in to as the service account, its configuration is read and compared with the settings this
+script applies, and the result is stored in ups_audit.sqlite (and summarised in ups_audit_summary.csv). The units table has a row per UPS with its
+status (compliant, noncompliant or failed), the settings table every setting read, with numbers stored as numbers and enabled/disabled as 1/0, and
+the differences table every setting that is not what it should be. For example, which UPSes still have SNMPv3 turned off:
+
+SELECT upsIP, sysName FROM settings JOIN units USING (upsIP) WHERE section = 'snmpv3' AND name = 'SNMPv3 Access' AND value = 0
+
+UPSes are handed to the workers site by site in turn, a site being a sysLocation (or a /24 subnet with --group-by subnet), so the reboots and
+logins of a run are spread over the sites instead of landing on one site's uplink at the same time. --per-site sets how many UPSes of one site
+are worked on at once (by default as many as there are workers). When UPSes at a site time out or drop their connection that number is halved,
+and it grows back by one UPS at a time as UPSes finish without trouble. Logins as the service account all go to the same RADIUS servers, so they
+are rate limited to --radius-rate logins per second (5 by default) across all workers. A rejected or timed out RADIUS login halves the rate, and
+every accepted one brings it back up a step. When several runs share the RADIUS servers (like the shards of one fleet), give each a share of the rate.
+
+Every failure is sorted into a class: unreachable, connection-lost, auth-unknown-password, command-error, reboot-timeout, radius-verify-failed or
+other. The class is shown in the summary. UPSes that were unreachable, lost their connection, did not come back from a reboot in time or failed
+the RADIUS check are put aside and tried again at the end of the run, up to --retries times (2 by default), after waiting --retry-delay seconds
+(30 by default, doubled for every further retry). A retried UPS continues from the first step it did not finish. An unknown password or a
+command the NMC refuses will not go away by itself, so those UPSes are not retried.
+
+With --config-ini the RADIUS, network, system, email and SNMP settings that differ are not sent as CLI commands. They are written into one config.ini
+per UPS, uploaded over SFTP in a single transfer, and the NMC applies them and reboots once. After the reboot the configuration is read back to check
+every setting took. A copy of each config.ini, with the secrets left out, is kept in the ups_logs folder. The section and key names follow the NMC2
+config.ini layout; compare them with a config.ini downloaded from one of your cards before using this mode on a new firmware version.
+
 USE AT YOUR OWN RISK
 
 """
 
+logDirectory = Path("ups_logs")
+logFile = 'ups_log.jsonl'
+logQueue = queue.Queue()
+logWriterThread = None
+logWriterLock = threading.Lock()
+unitContext = threading.local()
+credentialCache = {}
+credentialLock = threading.Lock()
+timings = {}       # TimingStats per (category, name)
+timingsLock = threading.Lock()
+timingSample = 1000 # Durations kept per kind of timing for the p50 and p95, however many UPSes there are
+timingRandom = random.Random()
+journalFile = 'ups_journal.jsonl'
+journalLock = threading.Lock()
+preflightFile = 'ups_preflight.csv'
+preflightWorkers = 64 # Probes only wait on the network, so many more of them run at once than UPSes are configured
+preflightBatch = 256 # UPSes probed together, the next batch is probed while the workers are busy with this one
+preflightColumns = ['upsIP', 'sysName', 'kind', 'banner', 'seconds', 'error']
+inventoryFile = 'ups_list_rerun.csv'
+auditFile = 'ups_audit.sqlite'
+inventoryColumns = {'ip': 'upsIP', 'upsip': 'upsIP', 'sysname': 'sysName', 'name': 'sysName', 'syslocation': 'sysLocation', 'location': 'sysLocation'}
+# The steps of configureUPS in the order they run, as recorded in the journal
+pipelineStages = ['password', 'deviceUser', 'radius', 'network', 'system', 'email', 'snmp', 'verify']
+# The steps when the settings are pushed as a config.ini (--config-ini)
+configIniStages = ['password', 'deviceUser', 'configIni', 'verify']
+
+def logStatus(message, event='status', error=None, duration=None):
+    """
+    Queue a status line for the log writer. The UPS and step this thread is working on are added to it, so the worker threads
+    never wait on the console or the disk.
+    """
+    global logWriterThread
+    if logWriterThread is None:
+        with logWriterLock:
+            if logWriterThread is None:
+                logWriterThread = threading.Thread(target=logWriter, name='logWriter', daemon=True)
+                logWriterThread.start()
+    logQueue.put({
+        'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+        'upsIP': getattr(unitContext, 'upsIP', None),
+        'sysName': getattr(unitContext, 'sysName', None),
+        'stage': getattr(unitContext, 'stage', None),
+        'event': event,
+        'duration': round(duration, 3) if duration is not None else None,
+        'error': error,
+        'message': message,
+        'unitLog': getattr(unitContext, 'logFile', None),
+    })
+
+def logWriter():
+    """
+    Background thread that owns the console, ups_log.jsonl and the per UPS logs in ups_logs. It writes whatever is queued in
+    batches and flushes once per batch. Per UPS logs are kept open until that UPS has finished.
+    """
+    unitLogs = {}
+    with open(logFile, 'a') as jsonFile:
+        while True:
+            batch = [logQueue.get()]
+            while len(batch) < 500 and not logQueue.empty():
+                batch.append(logQueue.get_nowait())
+            for record in batch:
+                if record is None:
+                    for file in unitLogs.values():
+                        file.close()
+                    return
+                print(record['message'])
+                unitLog = record.pop('unitLog')
+                jsonFile.write(json.dumps(dict(record, message=record['message'].strip())) + "\n")
+                if unitLog is not None:
+                    if unitLog not in unitLogs:
+                        unitLogs[unitLog] = open(unitLog, 'a')
+                    unitLogs[unitLog].write(record['time'] + " " + record['message'] + "\n")
+                    if record['event'] == 'finished':
+                        unitLogs.pop(unitLog).close()
+            jsonFile.flush()
+            sys.stdout.flush()
+
+def stopLogging():
+    """
+    Wait for everything queued to be written and stop the log writer
+    """
+    global logWriterThread
+    with logWriterLock:
+        if logWriterThread is not None:
+            logQueue.put(None)
+            logWriterThread.join()
+            logWriterThread = None
+
+class TimingStats:
+    """
+    Count, total and maximum of one kind of timing, and a sample of at most timingSample of its durations for the percentiles. Every
+    duration has the same chance of being in the sample (reservoir sampling), so the memory used does not grow with the fleet.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.sample = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.sample) < timingSample:
+            self.sample.append(seconds)
+        else:
+            slot = timingRandom.randrange(self.count)
+            if slot < timingSample:
+                self.sample[slot] = seconds
+
+def recordTiming(category, name, seconds):
+    """
+    Add how long something took to the timing report
+    """
+    with timingsLock:
+        stats = timings.get((category, name))
+        if stats is None:
+            stats = timings[(category, name)] = TimingStats()
+        stats.add(seconds)
+
+def timed(category):
+    """
+    Decorator that records how long every call of the function takes under the given category ("step" or "wait")
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                recordTiming(category, function.__name__, time.monotonic() - started)
+        return wrapper
+    return decorator
+
+def percentile(values, fraction):
+    # Nearest rank, so the value returned is always one that was actually measured
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def writeTimingReport(results, elapsed):
+    """
+    Write where the time went during the run to ups_timing_report.txt and ups_timing_report.json: p50/p95/max for every step,
+    connect, command and wait, the slowest UPSes, and how much of the time was spent waiting on reboots versus working
+    """
+    stats = []
+    with timingsLock:
+        for (category, name), timing in sorted(timings.items()):
+            stats.append({'category': category, 'name': name, 'count': timing.count, 'p50': round(percentile(timing.sample, 0.50), 3),
+                'p95': round(percentile(timing.sample, 0.95), 3), 'max': round(timing.max, 3), 'total': round(timing.total, 3)})
+        idleSeconds = sum(timing.total for (category, name), timing in timings.items() if category == 'wait')
+    unitSeconds = sum(result['seconds'] for result in results)
+    slowest = sorted(results, key=lambda result: result['seconds'], reverse=True)[0:10]
+    report = {
+        'elapsed': round(elapsed, 1),
+        'units': len(results),
+        'unitSeconds': round(unitSeconds, 1),
+        'idleSeconds': round(idleSeconds, 1),
+        'activeSeconds': round(max(unitSeconds - idleSeconds, 0), 1),
+        'stats': stats,
+        'slowestUnits': [{'upsIP': result['upsIP'], 'sysName': result['sysName'], 'status': result['status'], 'seconds': result['seconds'],
+            'readySeconds': result.get('readySeconds', 0.0)} for result in slowest],
+    }
+    with open('ups_timing_report.json', 'w') as file:
+        json.dump(report, file, indent=2)
+
+    lines = ["Timing report: " + str(report['units']) + " UPSes in " + str(report['elapsed']) + " seconds",
+        "Time spent on UPSes: " + str(report['unitSeconds']) + " seconds, " + str(report['activeSeconds']) + " working and "
+        + str(report['idleSeconds']) + " waiting on reboots", "",
+        "%-9s %-26s %7s %9s %9s %9s %10s" % ('category', 'name', 'count', 'p50', 'p95', 'max', 'total')]
+    for stat in stats:
+        lines.append("%-9s %-26s %7d %9.2f %9.2f %9.2f %10.1f" % (stat['category'], stat['name'], stat['count'], stat['p50'], stat['p95'], stat['max'], stat['total']))
+    lines += ["", "Slowest UPSes:"]
+    for unit in report['slowestUnits']:
+        lines.append("  %-40s %8.1f seconds (%.1f waiting on reboots) %s" % (unit['sysName'] + ' (' + unit['upsIP'] + ')', unit['seconds'], unit['readySeconds'], unit['status']))
+    with open('ups_timing_report.txt', 'w') as file:
+        file.write("\n".join(lines) + "\n")
+    logStatus("\n".join(lines) + "\n", event='timing report')
+
+class UPSSession:
+    """
+    A single logged in SSH session to a UPS that every configuration step runs on. The NMC2 is slow to set up SSH, so the session is only
+    opened again when a step is known to drop it (changing the password of the logged in account, or the reboot after the SNMP changes)
+    or when the NMC closed it on its own.
+    """
+    def __init__(self, ups, upsIP, username, password):
+        self.ups = ups
+        self.upsIP = upsIP
+        self.username = username
+        self.password = password
+        self.connection = None
+        self.logins = 0
+
+    def connect(self):
+        # Netmiko's is_alive() writes a null byte that the NMC would put in front of the next command, so only look at the transport
+        if self.connection is not None and not self.connection.remote_conn.get_transport().is_active():
+            logStatus(self.ups + " Session was closed by the NMC, logging in again...")
+            self.disconnect()
+        if self.connection is None:
+            myDevice = {
+                'host': self.upsIP,
+                'username': self.username,
+                'password': self.password,
+                'port': sshPort,
+                'device_type': 'cisco_ios',
+            }
+            if self.username == serviceUsername:
+                radiusLimit.acquire()
+            from netmiko import Netmiko
+            started = time.monotonic()
+            try:
+                self.connection = Netmiko(**myDevice)
+            except Exception:
+                if self.username == serviceUsername:
+                    radiusLimit.slowDown()
+                raise
+            if self.username == serviceUsername:
+                radiusLimit.speedUp()
+            recordTiming('connect', 'login as ' + ('service account' if self.username == serviceUsername else self.username), time.monotonic() - started)
+            self.logins += 1
+        return self.connection
+
+    def reconnect(self, password=None):
+        self.disconnect()
+        if password is not None:
+            self.password = password
+        return self.connect()
+
+    def disconnect(self):
+        if self.connection is not None:
+            # Netmiko's own disconnect checks for a Cisco config mode first and waits 10 seconds for a '#' prompt the NMC never sends
+            try:
+                self.connection.write_channel("exit\r")
+                self.connection.paramiko_cleanup()
+            except Exception:
+                pass    # The NMC may already have closed the session, e.g. when it is rebooting
+            self.connection = None
+
+promptPattern = r"apc>"   # Matches both the short "apc>" and the long "user@apc>" prompt
+statusPattern = re.compile(r"(E\d{3}):\s*([^\r\n]*)")
+successCodes = ('E000', 'E001', 'E002') # Success, Successfully Issued, Reboot required for change to take effect
+
+class UPSError(Exception):
+    """
+    A failure on a UPS that knows what kind of failure it is, see classifyFailure
+    """
+    failureClass = 'other'
+
+class UnknownPasswordError(UPSError):
+    """
+    The UPS did not accept any of the passwords it could be using
+    """
+    failureClass = 'auth-unknown-password'
+
+class CommandError(UPSError):
+    """
+    The NMC answered a command with an error code (E1xx) or did not answer it with a status code at all
+    """
+    failureClass = 'command-error'
+    def __init__(self, ups, command, code, message):
+        # Only the command and its option are kept, the value may be a password or secret
+        self.command = " ".join(command.split()[0:2])
+        self.code = code
+        self.message = message
+        super().__init__(ups + " " + self.command + " failed: " + str(code) + " " + message)
+
+def readUntilPrompt(net_connect, timeout=20):
+    """
+    Read from the session until the prompt comes back, like Netmiko's read_until_pattern, but give up straight away when the NMC
+    has closed the session instead of waiting out the timeout on a dead channel
+    """
+    from netmiko.exceptions import ReadTimeout
+    channel = net_connect.remote_conn
+    output = ''
+    deadline = time.monotonic() + timeout
+    while True:
+        received = net_connect.read_channel()
+        output += received
+        if re.search(promptPattern, output):
+            return output
+        if channel.closed or (channel.eof_received and not channel.recv_ready()):
+            raise ConnectionResetError("the NMC closed the session")
+        if time.monotonic() > deadline:
+            raise ReadTimeout("no prompt within " + str(timeout) + " seconds")
+        if received == '':
+            time.sleep(0.01)
+
+def runCommands(ups, session, commands, timeout=20):
+    """
+    Send NMC CLI commands one at a time over the session, waiting for the prompt to come back after each one instead of sleeping.
+    Stops at the first command that does not return a success code. Returns a list with the status code, message, output and
+    time taken for every command.
+    """
+    net_connect = session.connect()
+    results = []
+    for command in commands:
+    #   print(command)      # Uncomment this for debugging
+        started = time.monotonic()
+        net_connect.write_channel(command + "\r")
+        output = readUntilPrompt(net_connect, timeout)
+        status = statusPattern.search(output)
+        result = {
+            'command': command,
+            'code': status.group(1) if status else None,
+            'message': status.group(2).strip() if status else '',
+            'output': output,
+            'seconds': time.monotonic() - started,
+        }
+        results.append(result)
+        recordTiming('command', command.split()[0], result['seconds'])
+        if result['code'] not in successCodes:
+            raise CommandError(ups, command, result['code'], result['message'] or "no status code returned")
+    return results
+
+class RebootTimeoutError(UPSError):
+    """
+    The NMC did not come back on the SSH port before the deadline
+    """
+    failureClass = 'reboot-timeout'
+
+# Failures that may well not happen again a little later, the UPSes that ran into one are retried at the end of the run
+transientFailures = ('unreachable', 'connection-lost', 'reboot-timeout', 'radius-verify-failed')
+
+def classifyFailure(error, stage=None):
+    """
+    Sort an exception that ended the work on a UPS into unreachable, connection-lost (the connection broke while working on the UPS),
+    auth-unknown-password, command-error, reboot-timeout, radius-verify-failed or other. Netmiko's and paramiko's exceptions are recognised
+    by name, so neither has to be loaded for this.
+    """
+    if isinstance(error, UPSError):
+        return error.failureClass
+    name = error.__class__.__name__
+    names = [errorClass.__name__ for errorClass in error.__class__.__mro__]
+    # paramiko raises a plain OSError("Socket is closed") when the NMC hangs up during the login
+    lost = isinstance(error, (EOFError, ConnectionResetError, ConnectionAbortedError, BrokenPipeError)) or str(error) == 'Socket is closed'
+    if name in ('NetmikoAuthenticationException', 'AuthenticationException', 'BadAuthenticationType'):
+        # Only the service account logs in through RADIUS
+        return 'radius-verify-failed' if stage in ('radius', 'configIni', 'verify', 'audit') else 'auth-unknown-password'
+    # NetmikoTimeoutException is an SSHException too, but means the UPS did not answer at all
+    if isinstance(error, OSError) and not lost or name == 'NetmikoTimeoutException':
+        return 'unreachable'
+    if lost or 'SSHException' in names or name == 'ReadTimeout':
+        return 'connection-lost'
+    return 'other'
+
+def failureDetail(error, failureClass):
+    """
+    One line for the summary about why a UPS failed: the failure class and the first line of the error, since Netmiko's errors go on
+    for several lines of advice
+    """
+    lines = [line.strip() for line in str(error).splitlines() if line.strip() != '']
+    return failureClass + ": " + (lines[0] if len(lines) > 0 else error.__class__.__name__)
+
+def readBanner(upsIP, timeout=3):
+    """
+    Open a TCP connection to the SSH port of the UPS without logging in and read what it sends first. Returns whether the port
+    answered, the text it sent (an SSH banner starts with "SSH-") and the class of the error that ended the attempt, if any.
+    """
+    try:
+        sock = socket.create_connection((upsIP, sshPort), timeout=timeout)
+    except OSError as error:
+        return False, '', error.__class__.__name__
+    try:
+        return True, sock.recv(256).decode('ascii', 'replace').strip(), ''
+    except OSError as error:
+        return True, '', error.__class__.__name__
+    finally:
+        sock.close()
+
+def sshBanner(upsIP, timeout=3):
+    """
+    Return the SSH banner the UPS sends on its SSH port, or None when it does not answer with one
+    """
+    connected, banner, error = readBanner(upsIP, timeout)
+    if banner.startswith('SSH-'):
+        return banner
+    return None
+
+def probeUPS(upsIP, timeout=3):
+    """
+    Connect to the SSH port of a UPS without logging in and tell from the SSH banner what is listening: "nmc2", "other ssh",
+    "no banner" when the port answers but SSH does not, or "unreachable"
+    """
+    probe = {'upsIP': upsIP, 'kind': 'unreachable', 'banner': '', 'seconds': 0.0, 'error': ''}
+    started = time.monotonic()
+    connected, probe['banner'], probe['error'] = readBanner(upsIP, timeout)
+    if connected:
+        if not probe['banner'].startswith('SSH-'):
+            probe['kind'] = 'no banner'
+        elif 'cryptlib' in probe['banner']:
+            probe['kind'] = 'nmc2'  # The NMC2 SSH server is built on cryptlib, it announces itself as "SSH-2.0-cryptlib"
+        else:
+            probe['kind'] = 'other ssh'
+    probe['seconds'] = round(time.monotonic() - started, 3)
+    recordTiming('connect', 'preflight', probe['seconds'])
+    return probe
+
+def preflight(rows, report):
+    """
+    Probe every UPS in rows at the same time and write the outcome to report, a csv.DictWriter for ups_preflight.csv. Returns the rows to
+    configure, NMC2s first and UPSes without a banner last, and a failed result for every UPS that is left out.
+    """
+    logStatus("Preflight: checking " + str(len(rows)) + " UPSes...\n")
+    with ThreadPoolExecutor(max_workers=preflightWorkers) as pool:
+        probes = list(pool.map(lambda row: probeUPS(row[0]), rows))
+
+    for row, probe in zip(rows, probes):
+        report.writerow(dict(probe, sysName=row[1]))
+
+    live = [row for row, probe in zip(rows, probes) if probe['kind'] == 'nmc2'] + [row for row, probe in zip(rows, probes) if probe['kind'] == 'no banner']
+    dropped = []
+    for row, probe in zip(rows, probes):
+        if probe['kind'] in ('nmc2', 'no banner'):
+            continue
+        detail = 'preflight: unreachable' if probe['kind'] == 'unreachable' else 'preflight: not an NMC2 (' + probe['banner'] + ')'
+        logStatus(row[1] + ' (' + row[0] + ') left out, ' + detail[len('preflight: '):], event='preflight', error=probe['error'] or None)
+        dropped.append({'ups': row[1] + ' (' + row[0] + ')', 'upsIP': row[0], 'sysName': row[1], 'sysLocation': row[2], 'status': 'failed',
+            'detail': detail, 'failureClass': 'unreachable' if probe['kind'] == 'unreachable' else 'other', 'attempts': 1, 'seconds': probe['seconds'],
+            'readySeconds': 0.0})
+    logStatus("Preflight: " + str(len(live)) + " UPSes to configure, " + str(len(dropped)) + " left out, see " + preflightFile + "\n")
+    return live, dropped
+
+def sessionResponding(session, timeout=3):
+    """
+    Check if the NMC still answers with a prompt on an already open session
+    """
+    if session is None or session.connection is None:
+        return False
+    try:
+        session.connection.write_channel("\r")
+        session.connection.read_until_pattern(promptPattern, read_timeout=timeout)
+        return True
+    except Exception:
+        return False
+
+@timed('wait')
+def waitForReboot(ups, upsIP, session=None, rebootWindow=5, deadline=300):
+    """
+    Find out whether the NMC is rebooting and if so wait until SSH answers again. For rebootWindow seconds the open session
+    (or the SSH port when there is no session) is checked for the card going away, if it keeps answering it did not reboot and
+    there is nothing to wait for. Once the card went away the SSH port is polled with exponential backoff until it answers with
+    an SSH banner, giving up with a RebootTimeoutError after deadline seconds. Returns the number of seconds spent waiting.
+    """
+    started = time.monotonic()
+    rebooting = False
+    while time.monotonic() - started < rebootWindow:
+        if session is not None and session.connection is not None:
+            answering = sessionResponding(session)
+        else:
+            answering = sshBanner(upsIP) is not None
+        if not answering:
+            rebooting = True
+            break
+        time.sleep(1)
+    if not rebooting:
+        logStatus(ups + " NMC did not reboot, continuing\n")
+        return time.monotonic() - started
+
+    logStatus(ups + " NMC is rebooting, waiting for it to come back...\n")
+    if session is not None:
+        session.disconnect()
+    delay = 0.5
+    while sshBanner(upsIP) is None:
+        if time.monotonic() - started > deadline:
+            raise RebootTimeoutError(ups + " did not come back within " + str(deadline) + " seconds")
+        time.sleep(delay)
+        delay = min(delay * 2, 8)
+    waited = time.monotonic() - started
+    logStatus(ups + " NMC is back after " + str(round(waited, 1)) + " seconds\n")
+    return waited
+
+def rememberCredential(upsIP, username, password):
+    """
+    Remember which password logged in to a UPS so later steps and retries do not have to find it out again
+    """
+    with credentialLock:
+        credentialCache[(upsIP, username)] = password
+
+def cachedCredential(upsIP, username):
+    with credentialLock:
+        return credentialCache.get((upsIP, username))
+
+def openTransport(upsIP, timeout=10):
+    """
+    Open an SSH connection to the UPS without logging in. The host key is not checked, like ssh -o StrictHostKeyChecking=no
+    """
+    import paramiko
+    sock = socket.create_connection((upsIP, sshPort), timeout=timeout)
+    transport = paramiko.Transport(sock)
+    try:
+        transport.start_client(timeout=timeout)
+    except Exception:
+        transport.close()
+        raise
+    return transport
+
+def tryPasswords(upsIP, username, passwords, timeout=10):
+    """
+    Log in with each password in turn on the same SSH connection, only opening a new one if the NMC hangs up after too many
+    failures. Returns the password that worked and the logged in transport, or None and None when none of them did.
+    """
+    import paramiko
+    transport = None
+    started = time.monotonic()
+    try:
+        for password in passwords:
+            if transport is None or not transport.is_active():
+                if transport is not None:
+                    transport.close()
+                transport = openTransport(upsIP, timeout)
+            try:
+                try:
+                    transport.auth_password(username, password)
+                except paramiko.BadAuthenticationType as error:
+                    if 'keyboard-interactive' not in error.allowed_types:
+                        raise
+                    transport.auth_interactive(username, lambda title, instructions, prompts: [password] * len(prompts))
+                recordTiming('connect', 'password probe', time.monotonic() - started)
+                return password, transport
+            except paramiko.AuthenticationException:
+                continue
+    except Exception:
+        if transport is not None:
+            transport.close()
+        raise
+    if transport is not None:
+        transport.close()
+    recordTiming('connect', 'password probe', time.monotonic() - started)
+    return None, None
+
+def readUntil(channel, patterns, timeout=10):
+    """
+    Read from an interactive channel until one of the regular expressions matches. Returns the index of the pattern that matched
+    (None if none did before the timeout) and everything read. When the NMC closes the channel before anything matched, that is
+    a lost connection and not an answer, so a ConnectionResetError is raised.
+    """
+    output = ''
+    deadline = time.monotonic() + timeout
+    channel.settimeout(0.2)
+    while time.monotonic() < deadline:
+        for index, pattern in enumerate(patterns):
+            if re.search(pattern, output):
+                return index, output
+        try:
+            data = channel.recv(4096)
+        except socket.timeout:
+            continue
+        if not data:
+            for index, pattern in enumerate(patterns):
+                if re.search(pattern, output):
+                    return index, output
+            raise ConnectionResetError("the NMC closed the session")
+        output += data.decode('utf-8', 'replace')
+    for index, pattern in enumerate(patterns):
+        if re.search(pattern, output):
+            return index, output
+    return None, output
+
+passwordPolicyPattern = 'The current password policy requires you to change your password'
+
+def changeFirstPassword(ups, channel, defaultPassword, newPassword, prompt="apc>"):
+    """
+    Answer the questions a new or factory reset card asks on the first login to set a new password, on a shell that just showed them
+    """
+    channel.send(defaultPassword + "\r")
+    if readUntil(channel, ["Enter new password:"])[0] is None:
+        raise Exception(ups + " did not ask for a new password")
+    channel.send(newPassword + "\r")
+    readUntil(channel, ["password:"])
+    channel.send(newPassword + "\r")
+    if readUntil(channel, [prompt])[0] is None:
+        raise Exception(ups + " did not accept the new password")
+
+@timed('step')
 def firstLoginAttempt(ups, upsIP, username, defaultPassword, standardPassword, newPassword, passwordStatus, prompt="apc>"):
     """
-    Define variables
+    Find out which password the UPS accepts, trying the one that worked last time first, and set a new password if this is the
+    first login on a new or factory reset card
     """
+    import paramiko
     usingCurrentStdPW = False
     firstLogin = False
     usingNewStdPW = False
     usingDefaultPW = False
 
-    print(ups + " Checking if this is the first login...\n")
-    file = open("ups_log.txt", "a")
-    file.write(ups + " Checking if this is the first login...\n")
-    with wexpect.spawn(f"ssh -o StrictHostKeyChecking=no {username}@{upsIP}", timeout=10, encoding="utf-8") as ssh:
-    #   ssh.logfile = sys.stdout        # Uncomment this for debugging
-        ssh.expect("password")
-        ssh.sendline(defaultPassword)
-        firstLogin = ssh.expect(['The current password policy requires you to change your password', 'denied', prompt, wexpect.TIMEOUT])
-        if firstLogin == 0:
-            firstLogin = True
-            print(ups + ", First Time Login, setting password\n")
-            ssh.sendline(defaultPassword)
-            ssh.expect("Enter new password:")
-            ssh.sendline(newPassword)
-            time.sleep(0.5)
-            ssh.sendline(newPassword)
-            ssh.expect(prompt)
-            file.write(ups + ", First Time Login, setting password\n")
-            usingNewStdPW = True
-        elif firstLogin == 1:
-            firstLogin = False
-            ssh.sendline(standardPassword)
-            stdMatch = ssh.expect([prompt, 'denied'])
-            if stdMatch == 0:
-                usingCurrentStdPW = True
-                print(ups + " is using the current standard password\n")
-                file.write(ups + " is using the current standard password\n")
-            else:
-                ssh.sendline(newPassword)
-                newMatch = ssh.expect([prompt, "denied"])
-                if newMatch == 0:
+    logStatus(ups + " Checking if this is the first login...\n")
+    # Between rotations upsStandardPassword and upsNewPassword are the same, try that password only once
+    candidates = list(dict.fromkeys([defaultPassword, standardPassword, newPassword]))
+    cached = cachedCredential(upsIP, username)
+    if cached in candidates:
+        candidates.remove(cached)
+        candidates.insert(0, cached)
+    try:
+        password, transport = tryPasswords(upsIP, username, candidates)
+    except (OSError, paramiko.SSHException):
+        logStatus("ERROR: " + ups + " connection timed out\n")
+        raise
+
+    if password is None:
+        logStatus("ERROR: " + ups + " is using an unknown password\n")
+    else:
+        try:
+            if password == defaultPassword:
+                channel = transport.open_session()
+                channel.get_pty()
+                channel.invoke_shell()
+            #   print(readUntil(channel, [prompt])[1])      # Uncomment this for debugging
+                match, output = readUntil(channel, [passwordPolicyPattern, prompt])
+                if match == 0:
+                    firstLogin = True
+                    changeFirstPassword(ups, channel, defaultPassword, newPassword, prompt)
+                    password = newPassword
+                    logStatus(ups + ", First Time Login, setting password\n")
                     usingNewStdPW = True
-                    print(ups + " is using the new standard password\n")
-                    file.write(ups + " is using the new standard password\n")
+                elif match == 1:
+                    usingDefaultPW = True
+                    logStatus(ups + " is using the default password\n")
                 else:
-                    print("ERROR: " + ups + " is using an unknown password\n")
-                    file.write(ups + " is using an unknown password\n")
-        elif firstLogin == 2:
-            usingDefaultPW = True
-            print(ups + " is using the default password\n")
-            file.write(ups + " is using the default password\n")
+                    logStatus("ERROR: " + ups + " connection timed out\n")
+                    # The password worked, the card is just slow or still booting, so this is worth retrying
+                    raise ConnectionResetError(ups + " did not show a prompt after logging in")
+            elif password == newPassword:
+                # Checked before the current standard password, which is the same one between rotations and would be changed to itself
+                usingNewStdPW = True
+                logStatus(ups + " is using the new standard password\n")
+            else:
+                usingCurrentStdPW = True
+                logStatus(ups + " is using the current standard password\n")
+            rememberCredential(upsIP, username, password)
+        finally:
+            transport.close()
+
+    passwordStatus['firstTime'] = firstLogin
+    passwordStatus['currentStdPW'] = usingCurrentStdPW
+    passwordStatus['newStdPW'] = usingNewStdPW
+    passwordStatus['defaultPW'] = usingDefaultPW
+    return passwordStatus
+
+@timed('step')
+def standardizePassword(ups, session, currentPassword, newPassword):
+    logStatus(ups + " Standardizing password...\n")
+
+    net_connect = session.connect()
+    net_connect.write_channel("user -n apc -cp " + currentPassword + " -pw " + newPassword + "\r") # Have to add carriage return due to terminal width limitation
+    # The NMC may end the session right after the status line, so wait for the status code instead of the prompt
+    status = statusPattern.search(net_connect.read_until_pattern(r"E\d{3}:[^\r\n]*\n", read_timeout=10))
+    if status is None or status.group(1) not in successCodes:
+        raise CommandError(ups, "user -n", status.group(1) if status else None, status.group(2) if status else "no status code returned")
+    usingNewStdPW = True
+    rememberCredential(session.upsIP, session.username, newPassword)
+    logStatus(ups + " Standardized password\n")
+    # Changing the password of the account we are logged in with ends the session, log back in with the new one
+    session.reconnect(newPassword)
+    return usingNewStdPW
+
+# What the report of --rotate calls each password, so the passwords themselves never end up in it
+def credentialLabel(password):
+    if password is None:
+        return 'unknown'
+    if password == newPassword:
+        return 'new standard'
+    if password == standardPassword:
+        return 'current standard'
+    if password == defaultPassword:
+        return 'default'
+    return 'unknown'
+
+def rotatePassword(upsIP, sysName, sysLocation, prompt="apc>"):
+    """
+    Change the apc password of a single UPS to newPassword without touching anything else. Finding out which password it is on and changing it
+    happen on one SSH connection. The NMC ends the session when the password of the logged in account changes, so the new password is then
+    proved with a login that does not open a shell.
+    """
+    ups, result = beginUnit(upsIP, sysName, sysLocation)
+    result.update({'oldCredential': 'unknown', 'newCredential': 'unknown', 'result': 'failed', 'verified': False})
+    transport = None
+    try:
+        unitContext.stage = 'rotate'
+        candidates = [newPassword, standardPassword, defaultPassword]
+        cached = cachedCredential(upsIP, username)
+        if cached in candidates:
+            candidates.remove(cached)
+            candidates.insert(0, cached)
+        password, transport = tryPasswords(upsIP, username, candidates)
+        result['oldCredential'] = credentialLabel(password)
+        if password is None:
+            raise UnknownPasswordError(ups + ' is using an unknown password')
+        logStatus(ups + " is using the " + result['oldCredential'] + " password\n")
+
+        if password == newPassword:
+            result['result'] = 'already rotated'
+        else:
+            channel = transport.open_session()
+            channel.get_pty()
+            channel.invoke_shell()
+            match, output = readUntil(channel, [passwordPolicyPattern, prompt])
+            if match == 0:
+                changeFirstPassword(ups, channel, defaultPassword, newPassword, prompt)
+                result['result'] = 'rotated on first login'
+            elif match == 1:
+                channel.send("user -n " + username + " -cp " + password + " -pw " + newPassword + "\r")
+                status = statusPattern.search(readUntil(channel, [statusPattern.pattern])[1])
+                if status is None or status.group(1) not in successCodes:
+                    raise CommandError(ups, "user -n", status.group(1) if status else None, status.group(2) if status else "no status code returned")
+                result['result'] = 'rotated'
+            else:
+                # A slow or still booting card, not a refusal, so the UPS goes to the retry queue
+                raise ConnectionResetError(ups + " did not show a prompt after logging in")
+            rememberCredential(upsIP, username, newPassword)
+            logStatus(ups + " Changed the password to the new standard password\n")
+        transport.close()
+        transport = None
+
+        if result['result'] != 'already rotated':
+            verifiedPassword, verifyTransport = tryPasswords(upsIP, username, [newPassword])
+            if verifyTransport is not None:
+                verifyTransport.close()
+            result['verified'] = verifiedPassword is not None
+        else:
+            result['verified'] = True     # The login above was made with the new password
+        if result['verified']:
+            result['newCredential'] = 'new standard'
+            result['status'] = 'success'
+            logStatus(ups + " Logged in with the new standard password\n")
+        else:
+            result['newCredential'] = 'unknown'
+            result['detail'] = 'new password did not work'
+            logStatus("ERROR: " + ups + " could not log in with the new standard password\n", event='error')
+    except Exception as error:
+        logStatus(ups + " Could not rotate the password\n", event='error', error=error.__class__.__name__)
+        result['error'] = error.__class__.__name__
+        result['failureClass'] = classifyFailure(error, 'rotate')
+        result['detail'] = failureDetail(error, result['failureClass'])
+        if result['result'] == 'failed':
+            result['newCredential'] = result['oldCredential']     # Nothing was changed
+    finally:
+        if transport is not None:
+            transport.close()
+    return finishUnit(ups, result)
+
+def parseSettings(output):
+    """
+    Turn the "Name: value" lines an NMC show command prints into a dictionary. Settings that are listed once per index (email
+    recipients, SNMPv3 profiles) get the index added to their name, e.g. "Address 1". When a later block of the output reuses a
+    name, that block's heading is put in front of it, e.g. "SNMPv3 Access Control User Name 1".
+    """
+    settings = {}
+    heading = ''
+    index = ''
+    for line in output.splitlines():
+        line = line.strip()
+        if line == '' or re.search(promptPattern, line) or statusPattern.match(line):
+            continue
+        if ':' not in line:
+            heading = line
+            index = ''
+            continue
+        name, value = line.split(':', 1)
+        name = name.strip()
+        value = value.strip()
+        if name in ('Index', 'Recipient'):
+            index = value
+            continue
+        if index != '':
+            name = name + ' ' + index
+        if name in settings:
+            name = heading + ' ' + name
+        settings[name] = value
+    return settings
+
+def parseUsers(output):
+    """
+    Turn the output of "user -l" into a dictionary with every local username marked as present
+    """
+    users = {}
+    for line in output.splitlines():
+        if line.strip() == '' or re.search(promptPattern, line) or statusPattern.match(line.strip()) or line.strip() == 'user -l':
+            continue
+        users[line.split()[0]] = 'present'
+    return users
+
+@timed('step')
+def readCurrentConfig(ups, session):
+    """
+    Read the current configuration of the UPS in one go over the session and return it as a dictionary per section
+    """
+    logStatus(ups + " Reading current configuration...\n")
+    showCommands = ['tcpip', 'ntp', 'system', 'smtp', 'email', 'snmpv3', 'radius', 'user -l']
+    currentConfig = {}
+    for result in runCommands(ups, session, showCommands):
+        if result['command'] == 'user -l':
+            currentConfig['user'] = parseUsers(result['output'])
         else:
-            #print(ssh.read())      # Uncomment this for debugging
-            print("ERROR: " + ups + " connection timed out\n")
-            file.write("ERROR: " + ups + " connection timed out\n")
-        file.close()
-        ssh.close()
-
-        passwordStatus['firstTime'] = firstLogin
-        passwordStatus['currentStdPW'] = usingCurrentStdPW
-        passwordStatus['newStdPW'] = usingNewStdPW
-        passwordStatus['defaultPW'] = usingDefaultPW
-        return passwordStatus
-
-def standardizePassword(ups, upsIP, username, currentPassword, newPassword, prompt="apc>"):
-    print(ups + " Standardizing password...\n")
-    file = open("ups_log.txt", "a")
-    file.write(ups + " Standardizing password...\n")
-    
-    with wexpect.spawn(f"ssh {username}@{upsIP}", timeout=10, encoding="utf-8") as ssh:
-    #   ssh.logfile = sys.stdout        # Uncomment this for debugging
-        ssh.expect("password:")
-        ssh.sendline(currentPassword)
-        ssh.expect(prompt)
-        ssh.sendline("user -n apc -cp " + currentPassword + " -pw " + newPassword + "\r") # Have to add carriage return due to terminal width limitation
-        ssh.expect("Success")
-        usingNewStdPW = True
-        print(ups + " Standardized password\n")
-        file.write(ups + " Standardized password\n")
-        file.close()
-        ssh.close()
-        return usingNewStdPW
-
-def deleteUsername(ups, upsIP, username, password):
-        print(ups + ", Deleting \"device\" user...\n")
-        myDevice = {
-			'host': upsIP,
-			'username': username,
-			'password': password,
-			'device_type': 'cisco_ios',
-			}
-        net_connect = Netmiko(**myDevice)
-        userNameList = net_connect.send_command('user -l')
-        for line in userNameList.splitlines():
-            if line [0:6] == "device":
-                net_connect.send_command("user -del device")
-                print(ups + ", Deleted device user\n")
-                file = open("ups_log.txt", "a")
-                file.write(ups + ", Deleted device user\n")
-                file.close()
-                net_connect.disconnect()
-                time.sleep(2.5)     # Sometimes deleting this user after changing the superuser password causes a reboot, so we wait
+            currentConfig[result['command']] = parseSettings(result['output'])
+    # The prompt style is not part of any show command, the prompt itself tells us: "apc>" is short, "apc@apc>" is long. Netmiko cuts the
+    # prompt it keeps down to 16 characters, which can cut the "@" off behind a long username, so only the short prompt is looked for
+    currentConfig['prompt'] = {'Style': 'short' if session.connection.base_prompt == 'apc' else 'long'}
+    return currentConfig
+
+def settingMatches(expected, value):
+    """
+    Compare a value read from the NMC with the values it is allowed to have, ignoring case, spaces and punctuation
+    """
+    normalized = re.sub(r'[^a-z0-9]', '', value.lower())
+    return any(re.sub(r'[^a-z0-9]', '', option.lower()) == normalized for option in expected)
+
+def settingsToChange(settings, currentConfig):
+    """
+    Return the commands for the settings that differ from the current configuration. Each setting is a tuple of
+    (section, name, allowed values, command). Settings without allowed values are secrets that cannot be read back, or actions
+    like "ntp -u"; those are only sent when something else in their section has to change.
+    """
+    return [setting[3] for setting in changedSettings(settings, currentConfig)]
+
+def changedSettings(settings, currentConfig):
+    """
+    Like settingsToChange, but return the settings themselves instead of their commands
+    """
+    # Settings missing from the output count as different, so an unexpected output format means the commands are sent anyway
+    differs = [expected is not None and not settingMatches(expected, currentConfig.get(section, {}).get(name, 'absent')) for section, name, expected, command in settings]
+    changedSections = set(setting[0] for setting, differ in zip(settings, differs) if differ)
+    return [setting for setting, differ in zip(settings, differs) if differ or (setting[2] is None and setting[0] in changedSections)]
+
+def userSettings():
+    return [('user', 'device', ('absent',), 'user -del device')]
+
+def radiusSettings(radiusSecret):
+    return [('radius', 'Access', ('radiusLocal', 'RADIUS, then Local Authentication'), "radius -a radiusLocal "),
+    ('radius', 'Primary Server', ('X.X.X.X',), "radius -p1 X.X.X.X "),
+    ('radius', 'Primary Server Port', ('1812',), "radius -o1 1812 "),
+    ('radius', 'Primary Server Secret', None, "radius -s1 " + radiusSecret + " "),
+    ('radius', 'Primary Server Timeout', ('30',), "radius -t1 30 "),
+    ('radius', 'Secondary Server', ('X.X.X.X',), "radius -p2 X.X.X.X "),
+    ('radius', 'Secondary Server Port', ('1812',), "radius -o2 1812 "),
+    ('radius', 'Secondary Server Secret', None, "radius -s2 " + radiusSecret + " "),
+    ('radius', 'Secondary Server Timeout', ('30',), "radius -t2 30 ")]
+
+def networkSettings(sysName, sysDomain):
+    return [('tcpip', 'Domain Name', (sysDomain,), 'tcpip -d ' + sysDomain),
+    ('tcpip', 'Host Name', (sysName,), 'tcpip -h ' + sysName),
+    ('ntp', 'NTP status', ('enable', 'enabled'), 'ntp -e enable'),
+    ('ntp', 'Primary NTP Server', ('ntp1.' + sysDomain,), 'ntp -p ntp1.' + sysDomain),
+    ('ntp', 'Secondary NTP Server', ('ntp2.' + sysDomain,), 'ntp -s ntp2.' + sysDomain),
+    ('ntp', 'Update', None, 'ntp -u')]
+
+def systemSettings(sysName, sysLocation, emailDomain):
+    return [('system', 'Host Name Sync', ('enable', 'enabled'), 'system -s enable'),
+    ('system', 'Name', (sysName,), 'system -n ' + sysName),
+    ('system', 'Contact', ('example@' + emailDomain,), 'system -c example@' + emailDomain),
+    ('system', 'Location', (sysLocation,), 'system -l "' + sysLocation + '"'),
+    ('prompt', 'Style', ('long',), 'prompt -s long')]
+
+def emailSettings(sysName, emailDomain):
+    return [('smtp', 'From', (sysName + '@' + emailDomain,), 'smtp -f ' + sysName + '@' + emailDomain),
+    ('smtp', 'Server', ('smtp.example.com',), 'smtp -s smtp.example.com'),
+    ('smtp', 'Port', ('25',), 'smtp -p 25'),
+    ('email', 'Generation 1', ('enable', 'enabled'), 'email -g1 enable'),
+    ('email', 'Address 1', ('apc-alerts@' + emailDomain,), 'email -t1 apc-alerts@' + emailDomain),
+    ('email', 'Format 1', ('long',), 'email -o1 long'),
+    ('email', 'Language 1', ('enUs', 'English'), 'email -l1 enUs'),
+    ('email', 'Route 1', ('local',), 'email -r1 local')]
+
+def snmpSettings(upsSNMPv3user, upsSNMPv3auth, upsSNMPv3priv):
+    return [('snmpv3', 'SNMPv3 Access', ('enable', 'enabled'), 'snmpv3 -S enable'),
+    ('snmpv3', 'User Name 1', (upsSNMPv3user,), 'snmpv3 -u1 ' + upsSNMPv3user),
+    ('snmpv3', 'Authentication Passphrase 1', None, 'snmpv3 -a1 ' + upsSNMPv3auth),
+    ('snmpv3', 'Privacy Passphrase 1', None, 'snmpv3 -c1 ' + upsSNMPv3priv),
+    ('snmpv3', 'Authentication 1', ('md5',), 'snmpv3 -ap1 md5'), # Change as necessary
+    ('snmpv3', 'Encryption 1', ('des',), 'snmpv3 -pp1 des'), # Change as necessary
+    ('snmpv3', 'Access 1', ('enable', 'enabled'), 'snmpv3 -ac1 enable'),
+    ('snmpv3', 'SNMPv3 Access Control User Name 1', (upsSNMPv3user,), 'snmpv3 -au1 ' + upsSNMPv3user),
+    ('snmpv3', 'NMS IP/Host Name 1', ('X.X.X.X',), 'snmpv3 -n1 X.X.X.X'), # Add IP of SNMP monitoring host
+    ('snmpv3', 'Access 2', ('enable', 'enabled'), 'snmpv3 -ac2 enable'),
+    ('snmpv3', 'SNMPv3 Access Control User Name 2', (upsSNMPv3user,), 'snmpv3 -au2 ' + upsSNMPv3user),
+    ('snmpv3', 'NMS IP/Host Name 2', ('X.X.X.X',), 'snmpv3 -n2 X.X.X.X')] # Add IP of SNMP monitoring host
+
+def desiredSettings(sysName, sysLocation, withSecrets=True):
+    """
+    Every setting this script manages, for one UPS. Without withSecrets the secrets in the commands are a placeholder, which is enough
+    to compare against since secrets cannot be read back.
+    """
+    secret = lambda value: value if withSecrets else '<secret>'
+    return (userSettings() + radiusSettings(secret(radiusSecret)) + networkSettings(sysName, sysDomain) + systemSettings(sysName, sysLocation, emailDomain)
+        + emailSettings(sysName, emailDomain) + snmpSettings(upsSNMPv3user, secret(upsSNMPv3auth), secret(upsSNMPv3priv)))
+
+# Where every setting goes in config.ini, as (section, key). Settings that are not listed, like the prompt style, are still sent as CLI commands
+# and actions like "ntp -u" are left out
+configIniKeys = {
+    ('radius', 'Access'): ('NetworkRADIUS', 'Access'),
+    ('radius', 'Primary Server'): ('NetworkRADIUS', 'ServerPrimary'),
+    ('radius', 'Primary Server Port'): ('NetworkRADIUS', 'PortPrimary'),
+    ('radius', 'Primary Server Secret'): ('NetworkRADIUS', 'SecretPrimary'),
+    ('radius', 'Primary Server Timeout'): ('NetworkRADIUS', 'TimeoutPrimary'),
+    ('radius', 'Secondary Server'): ('NetworkRADIUS', 'ServerSecondary'),
+    ('radius', 'Secondary Server Port'): ('NetworkRADIUS', 'PortSecondary'),
+    ('radius', 'Secondary Server Secret'): ('NetworkRADIUS', 'SecretSecondary'),
+    ('radius', 'Secondary Server Timeout'): ('NetworkRADIUS', 'TimeoutSecondary'),
+    ('tcpip', 'Domain Name'): ('NetworkTCP/IP', 'DomainName'),
+    ('tcpip', 'Host Name'): ('NetworkTCP/IP', 'HostName'),
+    ('ntp', 'NTP status'): ('SystemDate/Time', 'NTPEnable'),
+    ('ntp', 'Primary NTP Server'): ('SystemDate/Time', 'NTPPrimaryServer'),
+    ('ntp', 'Secondary NTP Server'): ('SystemDate/Time', 'NTPSecondaryServer'),
+    ('system', 'Host Name Sync'): ('SystemID', 'HostNameSync'),
+    ('system', 'Name'): ('SystemID', 'Name'),
+    ('system', 'Contact'): ('SystemID', 'Contact'),
+    ('system', 'Location'): ('SystemID', 'Location'),
+    ('smtp', 'From'): ('NetworkSMTP', 'From'),
+    ('smtp', 'Server'): ('NetworkSMTP', 'Server'),
+    ('smtp', 'Port'): ('NetworkSMTP', 'Port'),
+    ('email', 'Generation 1'): ('EmailRecipient1', 'Generation'),
+    ('email', 'Address 1'): ('EmailRecipient1', 'Address'),
+    ('email', 'Format 1'): ('EmailRecipient1', 'Format'),
+    ('email', 'Language 1'): ('EmailRecipient1', 'Language'),
+    ('email', 'Route 1'): ('EmailRecipient1', 'Route'),
+    ('snmpv3', 'SNMPv3 Access'): ('NetworkSNMP', 'SNMPv3Access'),
+    ('snmpv3', 'User Name 1'): ('SNMPv3UserProfile1', 'UserName'),
+    ('snmpv3', 'Authentication Passphrase 1'): ('SNMPv3UserProfile1', 'AuthPhrase'),
+    ('snmpv3', 'Privacy Passphrase 1'): ('SNMPv3UserProfile1', 'PrivPhrase'),
+    ('snmpv3', 'Authentication 1'): ('SNMPv3UserProfile1', 'AuthProtocol'),
+    ('snmpv3', 'Encryption 1'): ('SNMPv3UserProfile1', 'PrivProtocol'),
+    ('snmpv3', 'Access 1'): ('SNMPv3AccessControl1', 'Access'),
+    ('snmpv3', 'SNMPv3 Access Control User Name 1'): ('SNMPv3AccessControl1', 'UserName'),
+    ('snmpv3', 'NMS IP/Host Name 1'): ('SNMPv3AccessControl1', 'NMSHostIP'),
+    ('snmpv3', 'Access 2'): ('SNMPv3AccessControl2', 'Access'),
+    ('snmpv3', 'SNMPv3 Access Control User Name 2'): ('SNMPv3AccessControl2', 'UserName'),
+    ('snmpv3', 'NMS IP/Host Name 2'): ('SNMPv3AccessControl2', 'NMSHostIP'),
+}
+configIniValues = {'enable': 'enabled', 'disable': 'disabled'}  # config.ini spells out what the CLI abbreviates
+
+def renderConfigIni(settings, hideSecrets=False):
+    """
+    Write the settings that have a place in config.ini as the text of a config.ini. The value of each setting is the argument of its
+    CLI command, so the file always matches what the CLI steps would have sent.
+    """
+    sections = {}
+    for section, name, expected, command in settings:
+        if (section, name) not in configIniKeys:
+            continue
+        iniSection, iniKey = configIniKeys[(section, name)]
+        value = command.strip().split(None, 2)[2].strip('"')
+        if hideSecrets and expected is None:
+            value = '<hidden>'
+        sections.setdefault(iniSection, []).append(iniKey + '=' + configIniValues.get(value, value))
+    lines = []
+    for iniSection, keys in sections.items():
+        lines += ['[' + iniSection + ']'] + keys + ['']
+    return "\r\n".join(lines)
+
+def uploadConfigIni(ups, upsIP, password, text):
+    """
+    Upload a config.ini to the root of the NMC file system over SFTP. The NMC applies it as soon as the transfer finishes.
+    """
+    import paramiko
+    password, transport = tryPasswords(upsIP, username, [password])
+    if transport is None:
+        raise UnknownPasswordError(ups + " could not log in to upload config.ini")
+    try:
+        started = time.monotonic()
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        # The NMC processes the file as soon as it arrives instead of keeping it, so it cannot be checked with a stat afterwards
+        sftp.putfo(io.BytesIO(text.encode('utf-8')), 'config.ini', confirm=False)
+        sftp.close()
+        recordTiming('connect', 'config.ini upload', time.monotonic() - started)
+    finally:
+        transport.close()
+
+@timed('step')
+def pushConfigIni(ups, upsIP, session, currentConfig, sysName, sysLocation):
+    """
+    Send every RADIUS, network, system, email and SNMP setting that differs as one config.ini instead of CLI commands. The few settings
+    config.ini cannot hold are sent over the session first. Returns the settings that were put in config.ini.
+    """
+    settings = (radiusSettings(radiusSecret) + networkSettings(sysName, sysDomain) + systemSettings(sysName, sysLocation, emailDomain)
+        + emailSettings(sysName, emailDomain) + snmpSettings(upsSNMPv3user, upsSNMPv3auth, upsSNMPv3priv))
+    changed = changedSettings(settings, currentConfig)
+    cliCommands = [setting[3] for setting in changed if (setting[0], setting[1]) not in configIniKeys and setting[2] is not None]
+    if len(cliCommands) > 0:
+        runCommands(ups, session, cliCommands)
+    iniSettings = [setting for setting in changed if (setting[0], setting[1]) in configIniKeys]
+    if len(iniSettings) == 0:
+        logStatus(ups + " Settings already configured, no config.ini to upload\n")
+        return iniSettings
+
+    logStatus(ups + " Uploading config.ini with " + str(len(iniSettings)) + " settings...\n")
+    logDirectory.mkdir(exist_ok=True)
+    with open(logDirectory / (re.sub(r'[^\w.-]', '_', sysName) + '_' + upsIP + '_config.ini'), 'w', newline='') as file:
+        file.write(renderConfigIni(iniSettings, hideSecrets=True))
+    uploadConfigIni(ups, upsIP, session.password, renderConfigIni(iniSettings))
+    logStatus(ups + " Uploaded config.ini\n")
+    return iniSettings
+
+@timed('step')
+def deleteUsername(ups, session, currentConfig):
+        userCommands = settingsToChange(userSettings(), currentConfig)
+        if len(userCommands) > 0:
+                logStatus(ups + ", Deleting \"device\" user...\n")
+                runCommands(ups, session, userCommands)
+                logStatus(ups + ", Deleted device user\n")
                 return(True)
-                
-
-def configureRadius(ups, upsIP, username, password, radiusSecret):
-    print(ups + ", Configuring RADIUS...\n")
-    radiusCommands = ["radius -a radiusLocal ", 
-    "radius -p1 X.X.X.X ", 
-    "radius -o1 1812 ", 
-    "radius -s1 " + radiusSecret + " ", 
-    "radius -t1 30 ", 
-    "radius -p2 X.X.X.X ", 
-    "radius -o2 1812 ", 
-    "radius -s2 " + radiusSecret + " ", 
-    "radius -t2 30 "]
-
-    myDevice = {
-			'host': upsIP,
-			'username': username,
-			'password': password,
-			'device_type': 'cisco_ios',
-			}
-    net_connect = Netmiko(**myDevice)
-    radiusConfig = net_connect.send_command('radius')
-    for line in radiusConfig.splitlines():
-        if "0.0.0.0" in line:
-            for command in radiusCommands:
-            #   print(command)      # Uncomment this for debugging
-                net_connect.write_channel(command + "\r")
-                time.sleep(0.5)
-            print("\n" + ups + ", Configured RADIUS\n")
-            file = open("ups_log.txt", "a")
-            file.write("\n" + ups + ", Configured RADIUS\n")
-            file.close()
-            net_connect.disconnect()
-            return(True)
 
+
+@timed('step')
+def configureRadius(ups, session, currentConfig, radiusSecret):
+    radiusCommands = settingsToChange(radiusSettings(radiusSecret), currentConfig)
+    if len(radiusCommands) == 0:
+        logStatus(ups + ", RADIUS already configured\n")
+        return(False)
+    logStatus(ups + ", Configuring RADIUS...\n")
+    runCommands(ups, session, radiusCommands)
+    logStatus("\n" + ups + ", Configured RADIUS\n")
+    return(True)
+
+@timed('step')
 def checkRadius(ups, upsIP, username, password):
-    print(ups + " Checking RADIUS with " + username + "...\n")
-    file = open("ups_log.txt", "a")
-    file.write(ups + " Checking RADIUS with " + username + "...\n")
-    prompt = "apc>"
-    with wexpect.spawn(f"ssh -o StrictHostKeyChecking=no {username}@{upsIP}", timeout=10, encoding="utf-8") as ssh:
-    #   ssh.logfile = sys.stdout        # Uncomment this for debugging
-        ssh.expect("password")
-        ssh.sendline(password)
-        stdMatch = ssh.expect([prompt, 'denied'])
-        if stdMatch == 0:
-            print(ups + " RADIUS check successful\n")
-            file.write(ups + " RADIUS check successful\n")
-            file.close()
-            ssh.close()
-            return(True)
-        else:
-            print("ERROR: " + ups + " RADIUS check unsuccessful\n")
-            file.write("ERROR: " + ups + " RADIUS check unsuccessful\n")
-            file.close()
-            ssh.close()
-            return(False)
-        
-
-def configureNetworkSettings(ups, upsIP, username, password, sysName, sysDomain):
-    print(ups + " Configuring remaining network settings - NTP and hostname...\n")
-    file = open("ups_log.txt", "a")
-    file.write(ups + " Configuring remaining network settings - NTP and hostname...\n")
-    networkCommands = ['tcpip -d ' + sysDomain, 'tcpip -h ' + sysName, 'ntp -e enable', 'ntp -p ntp1.' + sysDomain, 'ntp -s ntp2' + sysDomain, 'ntp -u']
-    myDevice = {
-			'host': upsIP,
-			'username': username,
-			'password': password,
-			'device_type': 'cisco_ios',
-			}
-    net_connect = Netmiko(**myDevice)
-    for command in networkCommands:
-    #   print(command)      # Uncomment this for debugging
-        net_connect.write_channel(command + "\r")
-        time.sleep(0.5)
-    print("\n" + ups + " Configured network settings\n")
-    file.write("\n" + ups + " Configured network settings\n")
-    file.close()
-    net_connect.disconnect()
-
-def configureSystemSettings(ups, upsIP, username, password, sysName, sysLocation, emailDomain):
-    print(ups + " Configuring system settings...\n")
-    file = open("ups_log.txt", "a")
-    file.write(ups + " Configuring system settings...\n")
-    systemCommands = ['system -s enable', 
-    'system -n ' + sysName, 
-    'system -c example@' + emailDomain, 
-    'system -l "' + sysLocation + '"',
-    'prompt -s long']
-    myDevice = {'host': upsIP, 'username': username, 'password': password, 'device_type': 'cisco_ios',}
-    net_connect = Netmiko(**myDevice)
-    for command in systemCommands:
-    #   print(command)      # Uncomment this for debugging
-        net_connect.write_channel(command + "\r\r")
-        time.sleep(0.5)
-    print("\n" + ups + " Configured system settings\n")
-    file.write("\n" + ups + " Configured system settings\n")
-    file.close()
-    net_connect.disconnect()
-
-def configureEmailSettings(ups, upsIP, username, password, sysName, emailDomain):
-    print(ups + " Configuring email settings...\n")
-    file = open("ups_log.txt", "a")
-    file.write(ups + " Configuring email settings...\n")
-    emailCommands = ['smtp -f ' + sysName + '@' + emailDomain, 
-    'smtp -s smtp.example.com', 'smtp -p 25', 
-    'email -g1 enable', 
-    'email -t1 apc-alerts@' + emailDomain, 
-    'email -o1 long', 
-    'email -l1 enUs', 
-    'email -r1 local']
-    myDevice = {'host': upsIP, 'username': username, 'password': password, 'device_type': 'cisco_ios',}
-    net_connect = Netmiko(**myDevice)
-    for command in emailCommands:
-    #   print(command)      # Uncomment this for debugging
-        net_connect.write_channel(command + "\r")
-        time.sleep(0.5)
-    print("\n" + ups + " Configured email settings\n")
-    file.write("\n" + ups + " Configured email settings\n")
-    file.close()
-    net_connect.disconnect()
-
-def configureSNMPSettings(ups, upsIP, username, password, upsSNMPv3user, upsSNMPv3auth, upsSNMPv3priv):
-    print(ups + " Configuring SNMP settings...\n")
-    file = open("ups_log.txt", "a")
-    file.write(ups + " Configuring SNMP settings...\n")
-    snmpCommands = ['snmpv3 -S enable', 
-    'snmpv3 -u1 ' + upsSNMPv3user, 
-    'snmpv3 -a1 ' + upsSNMPv3auth, 
-    'snmpv3 -c1 ' + upsSNMPv3priv, 
-    'snmpv3 -ap1 md5', # Change as necessary
-    'snmpv3 -pp1 des', # Change as necessary
-    'snmpv3 -ac1 enable', 
-    'snmpv3 -au1 ' + upsSNMPv3user, 
-    'snmpv3 -n1 X.X.X.X', # Add IP of SNMP monitoring host
-    'snmpv3 -ac2 enable', 
-    'snmpv3 -au2 ' + upsSNMPv3user, 
-    'snmpv3 -n2 X.X.X.X'] # Add IP of SNMP monitoring host
-    myDevice = {'host': upsIP, 'username': username, 'password': password, 'device_type': 'cisco_ios',}
-    net_connect = Netmiko(**myDevice)
-    for command in snmpCommands:
-    #   print(command)        # Uncomment this for debugging
-        net_connect.write_channel(command + "\r\r")
-        time.sleep(0.5)
-    print("\n" + ups + " Configured SNMP settings\n")
-    file.write("\n" + ups + " Configured SNMP settings\n")
-    file.close()
-    net_connect.disconnect()
-    # Disconnecting triggers the necessary reboot to apply settings but not immediately, wait in function before exiting
-    time.sleep(7)
+    logStatus(ups + " Checking RADIUS with " + username + "...\n")
+    # Logging in is all that is needed, the NMC only lets the service account in once the RADIUS server accepted it
+    radiusLimit.acquire()
+    try:
+        password, transport = tryPasswords(upsIP, username, [password])
+    except Exception:
+        # A login the RADIUS server times out or hangs is a sign it is busy as much as a rejected one
+        radiusLimit.slowDown()
+        raise
+    if transport is not None:
+        transport.close()
+        radiusLimit.speedUp()
+        logStatus(ups + " RADIUS check successful\n")
+        return(True)
+    else:
+        radiusLimit.slowDown()
+        logStatus("ERROR: " + ups + " RADIUS check unsuccessful\n")
+        return(False)
+
+
+@timed('step')
+def configureNetworkSettings(ups, session, currentConfig, sysName, sysDomain):
+    networkCommands = settingsToChange(networkSettings(sysName, sysDomain), currentConfig)
+    if len(networkCommands) == 0:
+        logStatus(ups + " Network settings already configured\n")
+        return(False)
+    logStatus(ups + " Configuring remaining network settings - NTP and hostname...\n")
+    runCommands(ups, session, networkCommands)
+    logStatus("\n" + ups + " Configured network settings\n")
+    return(True)
+
+@timed('step')
+def configureSystemSettings(ups, session, currentConfig, sysName, sysLocation, emailDomain):
+    systemCommands = settingsToChange(systemSettings(sysName, sysLocation, emailDomain), currentConfig)
+    if len(systemCommands) == 0:
+        logStatus(ups + " System settings already configured\n")
+        return(False)
+    logStatus(ups + " Configuring system settings...\n")
+    runCommands(ups, session, systemCommands)
+    logStatus("\n" + ups + " Configured system settings\n")
+    return(True)
+
+@timed('step')
+def configureEmailSettings(ups, session, currentConfig, sysName, emailDomain):
+    emailCommands = settingsToChange(emailSettings(sysName, emailDomain), currentConfig)
+    if len(emailCommands) == 0:
+        logStatus(ups + " Email settings already configured\n")
+        return(False)
+    logStatus(ups + " Configuring email settings...\n")
+    runCommands(ups, session, emailCommands)
+    logStatus("\n" + ups + " Configured email settings\n")
+    return(True)
+
+@timed('step')
+def configureSNMPSettings(ups, session, currentConfig, upsSNMPv3user, upsSNMPv3auth, upsSNMPv3priv):
+    snmpCommands = settingsToChange(snmpSettings(upsSNMPv3user, upsSNMPv3auth, upsSNMPv3priv), currentConfig)
+    if len(snmpCommands) == 0:
+        # Nothing to change means nothing to reboot for
+        logStatus(ups + " SNMP settings already configured\n")
+        return(False)
+    logStatus(ups + " Configuring SNMP settings...\n")
+    runCommands(ups, session, snmpCommands)
+    logStatus("\n" + ups + " Configured SNMP settings\n")
+    # Disconnecting triggers the necessary reboot to apply settings but not immediately, the caller waits for it with waitForReboot
+    session.disconnect()
+    return(True)
 
 username = "apc"
 # If necessary, a RADIUS service account that can be used to perform the necessary configurations once RADIUS is enabled
@@ -309,148 +1208,752 @@ upsSNMPv3user = "exampleUser"
 emailDomain = "example.com"
 sysDomain = "example.local" # This would be your AD domain probably, it may be the same as emailDomain. If so, uncomment next line and comment this one
 # sysDomain = emailDomain
+sshPort = 22
+defaultWorkers = 8 # How many UPSes are configured at the same time, can be overridden with --workers or the upsWorkers environment variable
+radiusRate = 5 # Service account logins per second the RADIUS servers are sent, can be overridden with --radius-rate
+radiusBurst = 10 # Logins that may go out at once after a quiet spell
+retries = 2 # How many more times UPSes that failed for a reason that may pass are tried, can be overridden with --retries
+retryDelay = 30 # Seconds before the first retry, doubled for every retry after it, can be overridden with --retry-delay
 
-# Get passwords from environment variables. Comment out this section to prompt the user for passwords instead
+# Get passwords from environment variables, the ones that are not set are read from the secrets file by loadCredentials when the script is run
 standardPassword = os.environ.get('upsStandardPassword')
 newPassword = os.environ.get('upsNewPassword')
 upsSNMPv3auth = os.environ.get('upsSNMPv3auth')
 upsSNMPv3priv = os.environ.get('upsSNMPv3priv')
 radiusSecret = os.environ.get('radiusSecret')
+servicePassword = os.environ.get('upsServicePassword')
 
-"""
-# Alternatively, prompt user to input passwords. Uncomment this section to use this method
-
-print("Provide current standard password for UPS local account:")
-standardPassword = getpass()
-print("Provide new standard password for UPS local account:")
-newPassword = getpass()
-print('Provide auth password for SNMP account ' + upsSNMPv3user + ':')
-upsSNMPv3auth = getpass()
-print('Provide priv password for SNMP account ' + upsSNMPv3user + ':')
-upsSNMPv3priv = getpass()
-print("Provide RADIUS secret key:")
-radiusSecret = getpass()
-"""
+# The environment variable (and secrets file name) of every credential, and the credentials each subcommand needs
+credentialVariables = {'standardPassword': 'upsStandardPassword', 'newPassword': 'upsNewPassword', 'upsSNMPv3auth': 'upsSNMPv3auth',
+    'upsSNMPv3priv': 'upsSNMPv3priv', 'radiusSecret': 'radiusSecret', 'servicePassword': 'upsServicePassword'}
+subcommandCredentials = {
+    'rollout': ['standardPassword', 'newPassword', 'upsSNMPv3auth', 'upsSNMPv3priv', 'radiusSecret', 'servicePassword'],
+    'rotate': ['standardPassword', 'newPassword'],
+    'audit': ['servicePassword'],
+    'preflight': [],
+}
+
+def readSecretsFile(path):
+    """
+    Read a secrets file with one VARIABLE=value line per secret, named like the environment variables. Blank lines and lines starting
+    with # are skipped, everything after the first = is the value.
+    """
+    secrets = {}
+    with open(path) as file:
+        for number, line in enumerate(file, 1):
+            line = line.rstrip('\r\n')
+            if line.strip() == '' or line.strip().startswith('#'):
+                continue
+            name, separator, value = line.partition('=')
+            if separator == '':
+                # The line itself is not shown, it could well be a password
+                raise ValueError(path + " line " + str(number) + " is not a VARIABLE=value line")
+            secrets[name.strip()] = value
+    return secrets
+
+def loadCredentials(command, secretsFile=None):
+    """
+    Fill in the credentials command needs that were not set in the environment from secretsFile. Returns the environment variables
+    that are still missing.
+    """
+    secrets = readSecretsFile(secretsFile) if secretsFile else {}
+    missing = []
+    for name in subcommandCredentials[command]:
+        if globals()[name] is None:
+            globals()[name] = secrets.get(credentialVariables[name]) or None
+        if globals()[name] is None:
+            missing.append(credentialVariables[name])
+    return missing
+
+
+def beginStage(stage):
+    """
+    Note the step this thread is starting on, for the log and for the duration recorded with recordStage
+    """
+    unitContext.stage = stage
+    unitContext.stageStarted = time.monotonic()
+    return stage
+
+def recordStage(upsIP, sysName, stage, outcome, detail=''):
+    """
+    Append a line to the journal saying how a step went for a UPS. Every line is flushed to disk before returning so the journal
+    survives the script being stopped or crashing.
+    """
+    if stage != 'run':
+        duration = time.monotonic() - getattr(unitContext, 'stageStarted', time.monotonic())
+        recordTiming('stage', stage, duration)
+        logStatus(sysName + ' (' + upsIP + ') ' + stage + ' ' + outcome, event='stage ' + outcome, error=detail or None, duration=duration)
+    record = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'upsIP': upsIP, 'sysName': sysName, 'stage': stage, 'outcome': outcome, 'detail': detail}
+    with journalLock:
+        with open(journalFile, 'a') as file:
+            file.write(json.dumps(record) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+def readJournal():
+    """
+    Return the steps each UPS has finished according to the journal. A "run" line means the UPS was started from the beginning
+    again, so anything it finished before that does not count.
+    """
+    completedStages = {}
+    if not os.path.exists(journalFile):
+        return completedStages
+    with open(journalFile) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue    # A line that was only half written when the script was stopped
+            if record['stage'] == 'run':
+                completedStages[record['upsIP']] = set()
+            elif record['outcome'] == 'done':
+                completedStages.setdefault(record['upsIP'], set()).add(record['stage'])
+    return completedStages
+
+def beginUnit(upsIP, sysName, sysLocation):
+    """
+    Point this worker thread's log at a UPS and return its display name and an empty result for it
+    """
+    ups = sysName + ' (' + upsIP + ')'
+    logDirectory.mkdir(exist_ok=True)
+    unitContext.logFile = logDirectory / (re.sub(r'[^\w.-]', '_', sysName) + '_' + upsIP + '.txt')
+    unitContext.upsIP = upsIP
+    unitContext.sysName = sysName
+    unitContext.unitStarted = time.monotonic()
+    return ups, {'ups': ups, 'upsIP': upsIP, 'sysName': sysName, 'sysLocation': sysLocation, 'status': 'failed', 'detail': '', 'failureClass': '',
+        'attempts': 1, 'seconds': 0.0, 'readySeconds': 0.0}
+
+def finishUnit(ups, result):
+    result['seconds'] = round(time.monotonic() - unitContext.unitStarted, 1)
+    unitContext.stage = None
+    logStatus(ups + " Finished (" + result['status'] + ") after " + str(result['seconds']) + " seconds\n", event='finished', duration=result['seconds'])
+    unitContext.logFile = unitContext.upsIP = unitContext.sysName = None
+    result['readySeconds'] = round(result['readySeconds'], 1)
+    return result
+
+def configureUPS(upsIP, sysName, sysLocation, completed=frozenset(), useConfigIni=False):
+    """
+    Run every configuration step against a single UPS and return a summary of how it went. Runs on a worker thread, one UPS per thread.
+    Steps listed in completed were finished by an earlier run (see --resume) and are skipped. Each finished step is written to the journal.
+    With useConfigIni the settings are pushed as one config.ini instead of CLI commands (see --config-ini).
+    """
+    stages = configIniStages if useConfigIni else pipelineStages
+    ups, result = beginUnit(upsIP, sysName, sysLocation)
+
+    passwordStatus = dict()
+    passwordStatus['firstTime'] = False
+    passwordStatus['currentStdPW'] = False
+    passwordStatus['newStdPW'] = False
+    passwordStatus['defaultPW'] = False
+
+    if len(completed) == 0:
+        recordStage(upsIP, sysName, 'run', 'started')
+    else:
+        logStatus(ups + " Resuming, already completed: " + ", ".join(stage for stage in stages if stage in completed) + "\n")
+
+    session = None
+    stage = beginStage('password')
+    try:
+        if 'password' in completed:
+            currentPassword = cachedCredential(upsIP, username) or newPassword
+            passwordStatus['newStdPW'] = True
+            session = UPSSession(ups, upsIP, username, currentPassword)
+        else:
+            logStatus(ups + " Logging in now...")
 
-print("Provide password for account " + serviceUsername + ":")
-servicePassword = getpass()
-usingDefaultPW = False
-usingCurrentStdPW = False 
-usingNewStdPW = False
+            firstLoginAttempt(ups, upsIP, username, defaultPassword, standardPassword, newPassword, passwordStatus)
+            """
+            Check for which password a given UPS was already using, add to log file and print to console
+            """
+            if passwordStatus["defaultPW"] == passwordStatus['currentStdPW'] == passwordStatus['newStdPW'] == False:
+                logStatus(ups + ' is using an unknown password\n')
+                raise UnknownPasswordError(ups + ' is using an unknown password')
+            elif passwordStatus['newStdPW'] != True:
+                if passwordStatus["currentStdPW"] == True:
+                    currentPassword = standardPassword
+                    logStatus(ups + ' is using the current standard password\n')
+                elif passwordStatus["defaultPW"] == True:
+                    currentPassword = defaultPassword
+                    logStatus(ups + ' is using the default password\n')
+                session = UPSSession(ups, upsIP, username, currentPassword)
+                # A refused password change raises a CommandError, the failure is reported with it
+                standardizePassword(ups, session, currentPassword, newPassword)
+                currentPassword = newPassword
+                logStatus(ups + ' is now using the new standard password\n')
+            else:
+                currentPassword = newPassword
+                logStatus(ups + ' is already using the new standard password\n')
+                session = UPSSession(ups, upsIP, username, currentPassword)
+            recordStage(upsIP, sysName, 'password', 'done')
+
+        if any(stage not in completed for stage in stages[1:-1]):
+            # Read the whole configuration once, every step below only sends the commands for settings that differ from it. This is a
+            # step of its own, so a failure here is not put down to the password step that is already journaled as done.
+            stage = beginStage('readConfig')
+            currentConfig = readCurrentConfig(ups, session)
+
+        stage = beginStage('deviceUser')
+        if stage not in completed:
+            userExisted = deleteUsername(ups, session, currentConfig)
+            if userExisted != True:
+                logStatus(ups + ", device User does not exist\n")
+            """
+            Sometimes the NMC reboots after standardizing the password and then deleting the "device" user. Check if it does and
+            wait for the device to finish rebooting.
+            """
+            if userExisted == True or passwordStatus['newStdPW'] != True:
+                logStatus(ups + " Sometimes the NMC reboots after standardizing the password and then deleting the \"device\" user. Checking for reboot...\n")
+                result['readySeconds'] += waitForReboot(ups, upsIP, session)
+            recordStage(upsIP, sysName, stage, 'done')
+
+        stage = beginStage('configIni')
+        if useConfigIni and stage not in completed:
+            pushedSettings = pushConfigIni(ups, upsIP, session, currentConfig, sysName, sysLocation)
+            if len(pushedSettings) > 0:
+                session.disconnect()
+                logStatus(ups + " Waiting for the NMC to apply config.ini and reboot...\n")
+                result['readySeconds'] += waitForReboot(ups, upsIP, rebootWindow=30)
+                # Secrets cannot be read back, every other setting has to show the value that was uploaded
+                notApplied = [setting[1] for setting in changedSettings(pushedSettings, readCurrentConfig(ups, session)) if setting[2] is not None]
+                if len(notApplied) > 0:
+                    raise CommandError(ups, "config.ini", "not applied:", ", ".join(notApplied))
+                logStatus(ups + " Checked config.ini was applied\n")
+            if any(setting[0] == 'radius' for setting in pushedSettings) or len(completed) > 0:
+                if checkRadius(ups, upsIP, serviceUsername, servicePassword) == False:
+                    logStatus("ERROR: Verify RADIUS configuration for " + ups + "\n")
+                    result['detail'] = 'verify RADIUS configuration'
+                    result['failureClass'] = 'radius-verify-failed'
+            recordStage(upsIP, sysName, stage, 'failed' if result['detail'] != '' else 'done', result['detail'])
+
+        stage = beginStage('radius')
+        if not useConfigIni and stage not in completed:
+            radiusSet = configureRadius(ups, session, currentConfig, radiusSecret)
+            # When resuming, an earlier run may have sent the RADIUS settings and then failed the check, so check it again
+            if radiusSet == True or len(completed) > 0:
+                # try logging in with service account, if access denied RADIUS is not set, or set incorrectly
+                if checkRadius(ups, upsIP, serviceUsername, servicePassword) == False:
+                    logStatus("ERROR: Verify RADIUS configuration for " + ups + "\n")
+                    result['detail'] = 'verify RADIUS configuration'
+                    result['failureClass'] = 'radius-verify-failed'
+            recordStage(upsIP, sysName, stage, 'failed' if result['detail'] != '' else 'done', result['detail'])
 
-passwordStatus = dict()
-passwordStatus['firstTime'] = False
-passwordStatus['currentStdPW'] = False
-passwordStatus['newStdPW'] = False
-passwordStatus['defaultPW'] = False
-                
+        # The remaining settings are applied over the same session as the local superuser instead of logging in again as the service account
+        stage = beginStage('network')
+        if not useConfigIni and stage not in completed:
+            configureNetworkSettings(ups, session, currentConfig, sysName, sysDomain)
+            recordStage(upsIP, sysName, stage, 'done')
+        stage = beginStage('system')
+        if not useConfigIni and stage not in completed:
+            configureSystemSettings(ups, session, currentConfig, sysName, sysLocation, emailDomain)
+            recordStage(upsIP, sysName, stage, 'done')
+        stage = beginStage('email')
+        if not useConfigIni and stage not in completed:
+            configureEmailSettings(ups, session, currentConfig, sysName, emailDomain)
+            recordStage(upsIP, sysName, stage, 'done')
+        stage = beginStage('snmp')
+        if not useConfigIni and stage not in completed:
+            if configureSNMPSettings(ups, session, currentConfig, upsSNMPv3user, upsSNMPv3auth, upsSNMPv3priv) == True:
+                logStatus(ups + " Exiting after SNMP changes triggers reboot, waiting for reboot to finish...\n")
+                # The reboot does not start right away after disconnecting, so give it longer to go away
+                result['readySeconds'] += waitForReboot(ups, upsIP, rebootWindow=30)
+            recordStage(upsIP, sysName, stage, 'done')
 
-def main ():
+        stage = beginStage('verify')
+        logStatus(ups + " Attempting to log in with service account " + serviceUsername + "...\n")
+        serviceSession = UPSSession(ups, upsIP, serviceUsername, servicePassword)
+        net_connect = serviceSession.connect()
+        if serviceUsername + '@apc>' in net_connect.find_prompt():
+            logStatus(ups + " Log in successful\n")
+            logStatus("Completed configuration for " + ups + " successfully!\n")
+            result['status'] = 'success' if result['detail'] == '' else 'warning'
+            recordStage(upsIP, sysName, stage, 'done')
+        else:
+            logStatus("ERROR: " + ups + " Log in unsuccessful\n")
+            logStatus("Completed configuration for " + ups + ", check management connectivity\n")
+            result['status'] = 'warning'
+            result['detail'] = 'check management connectivity'
+            recordStage(upsIP, sysName, stage, 'failed', result['detail'])
+        serviceSession.disconnect()
+
+    except Exception as error:
+        logStatus("Login failed on: " + ups, event='error', error=error.__class__.__name__)
+        logStatus(ups + ", Could not login\n", event='error', error=error.__class__.__name__)
+        result['error'] = error.__class__.__name__
+        result['failureClass'] = classifyFailure(error, stage)
+        result['detail'] = failureDetail(error, result['failureClass'])
+        recordStage(upsIP, sysName, stage, 'failed', result['failureClass'])
+    finally:
+        if session is not None:
+            session.disconnect()
+
+    return finishUnit(ups, result)
+
+def typedValue(value):
+    """
+    Turn a value shown by the NMC into what it stands for: whole numbers become integers and enabled/disabled become 1/0, anything else stays text
+    """
+    if re.match(r'^-?\d+$', value):
+        return int(value)
+    if value.lower() in ('enabled', 'enable', 'disabled', 'disable'):
+        return 1 if value.lower().startswith('enable') else 0
+    return value
+
+def auditUPS(upsIP, sysName, sysLocation):
+    """
+    Read the configuration of a single UPS as the service account without changing anything, and compare it with the settings configureUPS
+    applies. The result also holds what was read ('config') and every setting that differs ('differences').
+    """
+    ups, result = beginUnit(upsIP, sysName, sysLocation)
+    result['config'] = {}
+    result['differences'] = []
+    session = UPSSession(ups, upsIP, serviceUsername, servicePassword)
+    try:
+        unitContext.stage = 'audit'
+        result['config'] = readCurrentConfig(ups, session)
+        # Secrets cannot be read back, so only the settings with a known value are compared
+        for section, name, expected, command in changedSettings(desiredSettings(sysName, sysLocation, withSecrets=False), result['config']):
+            if expected is not None:
+                result['differences'].append((section, name, result['config'].get(section, {}).get(name, 'absent'), ' or '.join(expected)))
+        if len(result['differences']) == 0:
+            result['status'] = 'success'
+            logStatus(ups + " Configuration is compliant\n")
+        else:
+            result['status'] = 'warning'
+            result['detail'] = str(len(result['differences'])) + " settings differ: " + ", ".join(difference[1] for difference in result['differences'])
+            logStatus(ups + " " + result['detail'] + "\n")
+    except Exception as error:
+        logStatus(ups + " Could not read the configuration\n", event='error', error=error.__class__.__name__)
+        result['error'] = error.__class__.__name__
+        result['failureClass'] = classifyFailure(error, 'audit')
+        result['detail'] = failureDetail(error, result['failureClass'])
+    finally:
+        session.disconnect()
+    return finishUnit(ups, result)
+
+def openAudit(path=auditFile):
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        PRAGMA journal_mode = WAL;
+        CREATE TABLE IF NOT EXISTS units (upsIP TEXT PRIMARY KEY, sysName TEXT, sysLocation TEXT, auditedAt TEXT, status TEXT, differences INTEGER,
+            detail TEXT, seconds REAL);
+        CREATE TABLE IF NOT EXISTS settings (upsIP TEXT, section TEXT, name TEXT, value, PRIMARY KEY (upsIP, section, name)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS differences (upsIP TEXT, section TEXT, name TEXT, value TEXT, expected TEXT, PRIMARY KEY (upsIP, section, name)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS unitsByStatus ON units (status);
+        CREATE INDEX IF NOT EXISTS settingsByName ON settings (section, name, value);
+        CREATE INDEX IF NOT EXISTS differencesByName ON differences (section, name);
+    """)
+    return connection
+
+def storeAudit(connection, result):
+    """
+    Replace what ups_audit.sqlite knows about a UPS with the result of auditing it. The configuration and differences are taken out of the
+    result afterwards so they do not stay in memory for the rest of the run.
+    """
+    config = result.pop('config', {})
+    differences = result.pop('differences', [])
+    if result['status'] == 'failed':
+        status = 'failed'
+    else:
+        status = 'compliant' if len(differences) == 0 else 'noncompliant'
+    with connection:
+        connection.execute("DELETE FROM settings WHERE upsIP = ?", (result['upsIP'],))
+        connection.execute("DELETE FROM differences WHERE upsIP = ?", (result['upsIP'],))
+        connection.execute("INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (result['upsIP'], result['sysName'], result.get('sysLocation', ''),
+            datetime.datetime.now().isoformat(timespec='seconds'), status, len(differences), result['detail'], result['seconds']))
+        connection.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?, ?, ?)",
+            [(result['upsIP'], section, name, typedValue(value)) for section, fields in config.items() for name, value in fields.items()])
+        connection.executemany("INSERT OR REPLACE INTO differences VALUES (?, ?, ?, ?, ?)", [(result['upsIP'],) + difference for difference in differences])
 
-    with open('ups_list_rerun.csv') as csvfile:
-        upslist = csv.reader(csvfile, delimiter=',', quotechar='|')
-        next(upslist)
+class TokenBucket:
+    """
+    Lets requests through at rate per second on average and up to burst at once, shared by every worker thread. slowDown halves the rate
+    when the other side shows signs of being overloaded, speedUp adds a tenth of the configured rate back after a request went through.
+    """
+    def __init__(self, rate, burst):
+        self.configuredRate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        started = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+        if time.monotonic() - started > 0.01:
+            recordTiming('limit', 'radius login', time.monotonic() - started)
+
+    def slowDown(self):
+        with self.lock:
+            self.rate = max(self.configuredRate / 16, self.rate / 2)
+
+    def speedUp(self):
+        with self.lock:
+            self.rate = min(self.configuredRate, self.rate + self.configuredRate / 10)
+
+radiusLimit = TokenBucket(radiusRate, radiusBurst)
+
+class SiteLimit:
+    """
+    How many UPSes of one site may be worked on at once. Halves when a UPS at the site failed in a way that points at an overloaded network or
+    RADIUS server, and grows back by one UPS for every limit UPSes that finished without trouble, up to the configured limit.
+    """
+    def __init__(self, limit):
+        self.configuredLimit = limit
+        self.limit = float(limit)
+        self.running = 0
+
+    def available(self):
+        return self.running < max(1, int(self.limit))
+
+    def finished(self, overloaded):
+        self.running -= 1
+        if overloaded:
+            self.limit = max(1.0, self.limit / 2)
+        else:
+            self.limit = min(float(self.configuredLimit), self.limit + 1 / self.limit)
+
+def overloaded(result):
+    # The failures that may pass are the ones that say more about the network or the RADIUS servers being busy than about the UPS itself
+    return result.get('failureClass') in transientFailures
+
+def siteByLocation(row):
+    return row[2].lower()
+
+def siteBySubnet(row):
+    return str(ipaddress.ip_network(row[0] + ('/24' if ':' not in row[0] else '/64'), strict=False))
+
+def runFleet(rows, task, workers, skipPreflight=False, handleResult=None, siteOf=siteByLocation, perSite=None, appendPreflight=False):
+    """
+    Run task(row) for every row on a pool of workers and return the results. The rows are probed by preflight in batches first, unless
+    skipPreflight is set. Rows are handed to the pool one site (siteOf(row)) at a time in turn, with at most perSite rows of a site running at
+    once (see SiteLimit). Only a limited number of rows are read ahead of the workers so the rest of the list is not read until it is needed.
+    handleResult is called with every result, the ones preflight left out included, as soon as it is in. With appendPreflight the
+    outcome of the preflight check is added to ups_preflight.csv instead of starting it over, for the retry passes of a run.
+    """
+    results = []
+    def finished(result):
+        if handleResult is not None:
+            handleResult(result)
+        results.append(result)
 
+    waiting = {}        # Rows per site that are not handed to the pool yet, in the order the sites were first seen
+    waitingRows = 0
+    siteLimits = {}
+    pending = {}        # Future of every row handed to the pool, and its site
+    # A list sorted by site needs to be read far enough ahead to find rows of other sites while one site is at its limit
+    readAhead = max(preflightBatch * 4, workers * 4)
+    rowBatches = batches(rows, preflightBatch)
+    listRead = False
+    with open(preflightFile, 'a' if appendPreflight else 'w', newline='') as csvfile:
+        preflightReport = csv.DictWriter(csvfile, fieldnames=preflightColumns)
+        if not appendPreflight:
+            preflightReport.writeheader()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                while not listRead and waitingRows < readAhead:
+                    batch = next(rowBatches, None)
+                    if batch is None:
+                        listRead = True
+                        break
+                    if not skipPreflight:
+                        batch, leftOut = preflight(batch, preflightReport)
+                        for result in leftOut:
+                            finished(result)
+                    for row in batch:
+                        waiting.setdefault(siteOf(row), []).append(row)
+                    waitingRows += len(batch)
+
+                # Take one row from every site with room in turn until the workers are all busy
+                handedOut = True
+                while handedOut and len(pending) < workers:
+                    handedOut = False
+                    for site in list(waiting):
+                        siteLimit = siteLimits.setdefault(site, SiteLimit(perSite or workers))
+                        if len(pending) >= workers or not siteLimit.available():
+                            continue
+                        row = waiting[site].pop(0)
+                        if len(waiting[site]) == 0:
+                            del waiting[site]
+                        waitingRows -= 1
+                        siteLimit.running += 1
+                        pending[pool.submit(task, row)] = site
+                        handedOut = True
+
+                if len(pending) == 0:
+                    if listRead and waitingRows == 0:
+                        break
+                    continue
+                for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                    result = future.result()
+                    site = pending.pop(future)
+                    siteLimits[site].finished(overloaded(result))
+                    if overloaded(result):
+                        logStatus("Slowing down at site " + site + " to " + str(max(1, int(siteLimits[site].limit))) + " UPSes at a time after "
+                            + result['ups'] + " failed with " + (result.get('error') or result['detail']), event='throttle')
+                    finished(result)
+    return results
+
+def preflightFleet(rows):
+    """
+    Only run the preflight check, batch by batch, over every UPS in rows. Returns the number of UPSes that would be configured and the
+    number that would be left out.
+    """
+    live = leftOut = 0
+    with open(preflightFile, 'w', newline='') as csvfile:
+        preflightReport = csv.DictWriter(csvfile, fieldnames=preflightColumns)
+        preflightReport.writeheader()
+        for batch in batches(rows, preflightBatch):
+            batch, dropped = preflight(batch, preflightReport)
+            live += len(batch)
+            leftOut += len(dropped)
+    return live, leftOut
+
+def writeSummary(results, elapsed, summaryFile='ups_summary.csv', columns=('upsIP', 'sysName', 'status', 'failureClass', 'detail', 'attempts', 'seconds',
+        'readySeconds')):
+    """
+    Print a summary of the run and save it to summaryFile
+    """
+    succeeded = [result for result in results if result['status'] == 'success']
+    warnings = [result for result in results if result['status'] == 'warning']
+    failed = [result for result in results if result['status'] == 'failed']
+
+    with open(summaryFile, 'w', newline='') as csvfile:
+        summary = csv.DictWriter(csvfile, fieldnames=list(columns), extrasaction='ignore')
+        summary.writeheader()
+        summary.writerows(results)
+
+    logStatus("Summary: " + str(len(results)) + " UPSes in " + str(round(elapsed, 1)) + " seconds")
+    logStatus("  Successful: " + str(len(succeeded)))
+    logStatus("  Completed with warnings: " + str(len(warnings)))
+    for result in warnings:
+        logStatus("    " + result['ups'] + ": " + result['detail'])
+    logStatus("  Failed: " + str(len(failed)))
+    for result in failed:
+        failureClass = result.get('failureClass') or 'other'
+        # The detail of an error already starts with its class
+        logStatus("    " + result['ups'] + ": " + result['detail'] + ("" if result['detail'].startswith(failureClass + ": ") else " (" + failureClass + ")"))
+
+def readInventory(path):
+    """
+    Yield the rows of a CSV or JSONL UPS list one at a time as dictionaries with upsIP, sysName and sysLocation
+    """
+    with open(path, newline='') as file:
+        if str(path).endswith('.jsonl'):
+            for line in file:
+                if line.strip() == '':
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = {}
+                if not isinstance(record, dict):
+                    record = {}     # Valid JSON but not an object, like [1, 2], is an invalid row as well
+                yield dict((inventoryColumns.get(str(key).lower(), key), value) for key, value in record.items())
+            return
+        upslist = csv.reader(file, delimiter=',', quotechar='|')
+        header = [inventoryColumns.get(column.strip().lower(), column.strip()) for column in next(upslist, [])]
+        if 'upsIP' not in header:
+            header = ['upsIP', 'sysName', 'sysLocation']     # An old list with the columns in this order and a header with other names
         for row in upslist:
-            upsIP = row[0]
-            sysName = row[1]
-            sysLocation = row[2]
+            if row:
+                yield dict(zip(header, (value.strip() for value in row)))
 
-            ups = sysName + ' (' + upsIP + ')'
+def inventoryRows(path, shard=None, sites=(), counts=None):
+    """
+    Yield (upsIP, sysName, sysLocation) for every row of the UPS list this run should configure: valid, the first row for its IP, in this
+    run's shard (shard is (i, n) for --shard i/n) and at one of the sites, if any are given. counts is filled in with what was skipped and why.
+    """
+    counts = counts if counts is not None else {}
+    for name in ('read', 'invalid', 'duplicate', 'otherShard', 'otherSite'):
+        counts.setdefault(name, 0)
+    seen = set()
+    wantedSites = set(site.lower() for site in sites)
+    for record in readInventory(path):
+        counts['read'] += 1
+        upsIP = str(record.get('upsIP') or '').strip()
+        sysName = str(record.get('sysName') or '').strip()
+        sysLocation = str(record.get('sysLocation') or '').strip()
+        try:
+            # One spelling per address, so an IPv6 address written two ways is one IP and lands in one shard
+            upsIP = str(ipaddress.ip_address(upsIP))
+        except ValueError:
+            upsIP = ''
+        if upsIP == '' or sysName == '' or sysLocation == '':
+            counts['invalid'] += 1
+            logStatus("Inventory: skipping row " + str(counts['read']) + ", it needs a valid IP, sysName and sysLocation: " + json.dumps(record), event='inventory')
+            continue
+        # Every row for an IP hashes to the same shard, so the duplicates are only looked for (and remembered) within this run's shard
+        if shard is not None and zlib.crc32(upsIP.encode('ascii')) % shard[1] != shard[0] - 1:
+            counts['otherShard'] += 1
+            continue
+        if upsIP in seen:
+            counts['duplicate'] += 1
+            logStatus("Inventory: skipping " + sysName + " (" + upsIP + "), the IP is already in the list", event='inventory')
+            continue
+        seen.add(upsIP)
+        if len(wantedSites) > 0 and sysLocation.lower() not in wantedSites:
+            counts['otherSite'] += 1
+            continue
+        yield (upsIP, sysName, sysLocation)
 
-            try:
-                myDevice = {
-                    'host': upsIP,
-                 	'username': serviceUsername,
-                 	'password': servicePassword,
-                 	'device_type': 'cisco_ios',
-                }
-                print(ups)
-                print("Logging in now...")
-                
-                firstLoginAttempt(ups, upsIP, username, defaultPassword, standardPassword, newPassword, passwordStatus)
-                """
-                Check for which password a given UPS was already using, add to log file and print to console
-                """
-                if passwordStatus["defaultPW"] == passwordStatus['currentStdPW'] == passwordStatus['newStdPW'] == False:
-                    print(ups + ' is using an unknown password\n')
-                    file = open("ups_log.txt", "a")
-                    file.write(ups + ' is using an unknown password\n')
-                    file.close()
-                    raise Exception(ups + ' is using an unknown password')
-                elif passwordStatus['newStdPW'] != True:
-                    if passwordStatus["currentStdPW"] == True:
-                        currentPassword = standardPassword
-                        print(ups + ' is using the current standard password\n')
-                        file = open("ups_log.txt", "a")
-                        file.write(ups + ' is using the current standard password\n')
-                        file.close()
-                    elif passwordStatus["defaultPW"] == True:
-                        currentPassword = defaultPassword
-                        print(ups + ' is using the default password\n')
-                        file = open("ups_log.txt", "a")
-                        file.write(ups + ' is using the default password\n')
-                        file.close()
-                    usingNewStdPW = standardizePassword(ups, upsIP, username, currentPassword, newPassword)
-                    if usingNewStdPW == True:
-                        currentPassword = newPassword
-                        print(ups + ' is now using the new standard password\n')
-                        file = open("ups_log.txt", "a")
-                        file.write(ups + ' is now using the new standard password\n')
-                        file.close()
-                    else:
-                        print('Could not set password for ' + ups + '\n')
-                        file = open("ups_log.txt", "a")
-                        file.write('Could not set password for ' + ups + '\n')
-                        file.close()
-                else:
-                    currentPassword = newPassword
-                    print(ups + ' is already using the new standard password\n')
-                    file = open("ups_log.txt", "a")
-                    file.write(ups + ' is already using the new standard password\n')
-                    file.close()
-
-                userExisted = deleteUsername(ups, upsIP, username, currentPassword)
-                if userExisted != True:
-                    file = open("ups_log.txt", "a")
-                    file.write(ups + ", device User does not exist\n")
-                    file.close()
-                """
-                Sometimes the NMC reboots after standardizing the password and then deleting the "device" user. Add a wait period
-                to allow for the device to finish rebooting.
-                """
-                print("Sometimes the NMC reboots after standardizing the password and then deleting the \"device\" user. Waiting for reboot...\n")
-                time.sleep(25)
-                radiusSet = configureRadius(ups, upsIP, username, currentPassword, radiusSecret)
-                if radiusSet == True:
-                    # try logging in with service account, if access denied RADIUS is not set, or set incorrectly
-                    if checkRadius(ups, upsIP, serviceUsername, servicePassword) == False:
-                        print("ERROR: Verify RADIUS configuration for " + ups + "\n")
-                        file = open("ups_log.txt", "a")
-                        file.write("ERROR: Verify RADIUS configuration for " + ups + "\n")
-                        file.close()
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def parseShard(value):
+    match = re.match(r'^(\d+)/(\d+)$', value)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError("expected i/n with 1 <= i <= n, like 1/4")
+    return (int(match.group(1)), int(match.group(2)))
 
-                configureNetworkSettings(ups, upsIP, serviceUsername, servicePassword, sysName, sysDomain)
-                configureSystemSettings(ups, upsIP, serviceUsername, servicePassword, sysName, sysLocation, emailDomain)
-                configureEmailSettings(ups, upsIP, serviceUsername, servicePassword, sysName, emailDomain)
-                configureSNMPSettings(ups, upsIP, serviceUsername, servicePassword, upsSNMPv3user, upsSNMPv3auth, upsSNMPv3priv)
-                print("Exiting after SNMP changes triggers reboot, waiting for reboot to finish...\n")
-                time.sleep(30)
-                print("Attempting to log in with service account " + serviceUsername + "...\n")
-                net_connect = Netmiko(**myDevice)
-                if serviceUsername + '@apc>' in net_connect.find_prompt():
-                    print("Log in successful\n")
-                    print("Completed configuration for " + ups + " successfully!\n")
+def runSubcommand(args):
+    """
+    Run the subcommand main parsed into args over the UPS list
+    """
+    resume = args.command == 'rollout' and args.resume
+    useConfigIni = args.command == 'rollout' and args.config_ini
+
+    inventoryCounts = {}
+    rows = inventoryRows(args.inventory, args.shard, args.site, inventoryCounts)
+    completedStages = readJournal() if resume else {}
+    if resume:
+        inventoryCounts['finished'] = 0
+        def unfinished(rows):
+            for row in rows:
+                if completedStages.get(row[0], set()) >= set(configIniStages if useConfigIni else pipelineStages):
+                    inventoryCounts['finished'] += 1
                 else:
-                    print("ERROR: Log in unsuccessful\n")
-                    print("Completed configuration for " + ups + ", check management connectivity\n")
-                net_connect.disconnect()
-                
-            except:
-                print("Login failed on: ", ups)
-                file = open("ups_log.txt", "a")
-                file.write(ups + ", Could not login\n")
-                file.close()
-                continue
+                    yield row
+        rows = unfinished(rows)
+
+    started = time.monotonic()
+    if args.command == 'preflight':
+        live, leftOut = preflightFleet(rows)
+        logStatus("Inventory: " + str(inventoryCounts['read']) + " rows read, " + str(inventoryCounts['invalid']) + " invalid, " + str(inventoryCounts['duplicate'])
+            + " duplicate IPs, " + str(inventoryCounts['otherShard']) + " in other shards, " + str(inventoryCounts['otherSite']) + " at other sites\n")
+        logStatus("Preflight finished in " + str(round(time.monotonic() - started, 1)) + " seconds: " + str(live) + " UPSes to configure, "
+            + str(leftOut) + " left out, see " + preflightFile + "\n")
+        return
+
+    siteOf = siteBySubnet if args.group_by == 'subnet' else siteByLocation
+    handleResult = None
+    if args.command == 'audit':
+        audit = openAudit()
+        task = lambda row: auditUPS(row[0], row[1], row[2])
+        handleResult = lambda result: storeAudit(audit, result)
+    elif args.command == 'rotate':
+        task = lambda row: rotatePassword(row[0], row[1], row[2])
+    else:
+        task = lambda row: configureUPS(row[0], row[1], row[2], frozenset(completedStages.get(row[0], set())), useConfigIni)
+    results = runFleet(rows, task, args.workers, args.skip_preflight, handleResult, siteOf, args.per_site)
+
+    # Try the UPSes that failed for a reason that may pass again, after the rest of the fleet is done
+    for attempt in range(1, args.retries + 1):
+        retryRows = [(result['upsIP'], result['sysName'], result.get('sysLocation', '')) for result in results
+            if result['status'] == 'failed' and result.get('failureClass') in transientFailures]
+        if not retryRows:
+            break
+        failureClasses = {}
+        for result in results:
+            if result['status'] == 'failed' and result.get('failureClass') in transientFailures:
+                failureClasses[result['failureClass']] = failureClasses.get(result['failureClass'], 0) + 1
+        delay = args.retry_delay * 2 ** (attempt - 1)
+        logStatus("Retry " + str(attempt) + " of " + str(args.retries) + ": " + str(len(retryRows)) + " UPSes ("
+            + ", ".join(str(count) + " " + name for name, count in sorted(failureClasses.items())) + ") in " + str(delay) + " seconds\n")
+        time.sleep(delay)
+        recordTiming('limit', 'retry backoff', delay)
+        if args.command == 'rollout':
+            # Continue every UPS from the first step it did not finish
+            completedStages = readJournal()
+        retried = {result['upsIP']: result for result in runFleet(retryRows, task, args.workers, args.skip_preflight, handleResult, siteOf, args.per_site,
+            appendPreflight=True)}
+        for number, result in enumerate(results):
+            if result['upsIP'] in retried:
+                retried[result['upsIP']]['attempts'] = result.get('attempts', 1) + 1
+                results[number] = retried[result['upsIP']]
+    if args.command == 'audit':
+        audit.close()
+
+    logStatus("Inventory: " + str(inventoryCounts['read']) + " rows read, " + str(inventoryCounts['invalid']) + " invalid, " + str(inventoryCounts['duplicate'])
+        + " duplicate IPs, " + str(inventoryCounts['otherShard']) + " in other shards, " + str(inventoryCounts['otherSite']) + " at other sites"
+        + (", " + str(inventoryCounts['finished']) + " already completed every step" if resume else "") + "\n")
+
+    if args.command == 'rotate':
+        writeSummary(results, time.monotonic() - started, 'ups_rotation_report.csv',
+            ['upsIP', 'sysName', 'oldCredential', 'newCredential', 'result', 'verified', 'status', 'failureClass', 'detail', 'attempts', 'seconds'])
+    else:
+        writeSummary(results, time.monotonic() - started, 'ups_audit_summary.csv' if args.command == 'audit' else 'ups_summary.csv')
+    writeTimingReport(results, time.monotonic() - started)
+
+def main (argv=None):
+    """
+    Run the subcommand given in argv (sys.argv by default), rollout when none is given
+    """
+    inventoryOptions = argparse.ArgumentParser(add_help=False)
+    inventoryOptions.add_argument('--inventory', default=inventoryFile, help="CSV or .jsonl list of UPSes, " + inventoryFile + " by default")
+    inventoryOptions.add_argument('--shard', type=parseShard, help="only work on shard i of n, like 2/4, to split the list over several runs")
+    inventoryOptions.add_argument('--site', action='append', default=[], help="only work on UPSes with this sysLocation, can be given more than once")
+    inventoryOptions.add_argument('--secrets-file', default=os.environ.get('upsSecretsFile'), help="file with VARIABLE=value lines for the secrets "
+        "that are not set in the environment")
+    fleetOptions = argparse.ArgumentParser(add_help=False)
+    fleetOptions.add_argument('--workers', type=int, default=int(os.environ.get('upsWorkers', defaultWorkers)), help="number of UPSes to work on at the same time")
+    fleetOptions.add_argument('--skip-preflight', action='store_true', help="do not check which UPSes answer as an NMC2 first")
+    fleetOptions.add_argument('--per-site', type=int, help="number of UPSes of one site to work on at the same time, as many as --workers by default")
+    fleetOptions.add_argument('--group-by', choices=['location', 'subnet'], default='location', help="what makes up a site: the sysLocation or the /24 subnet")
+    fleetOptions.add_argument('--radius-rate', type=float, default=radiusRate, help="service account logins per second sent to the RADIUS servers")
+    fleetOptions.add_argument('--retries', type=int, default=retries, help="times to retry UPSes that failed for a reason that may pass")
+    fleetOptions.add_argument('--retry-delay', type=float, default=retryDelay, help="seconds to wait before the first retry, doubled for every next one")
+
+    parser = argparse.ArgumentParser(description="Configure APC Smart-UPS NMC2 cards listed in " + inventoryFile)
+    subcommands = parser.add_subparsers(dest='command', metavar='{rollout,rotate,audit,preflight}')
+    rollout = subcommands.add_parser('rollout', parents=[inventoryOptions, fleetOptions], help="configure every UPS (the default)")
+    rollout.add_argument('--resume', action='store_true', help="continue each UPS from the first step it did not finish in an earlier run, according to " + journalFile)
+    rollout.add_argument('--config-ini', action='store_true', help="upload the settings as one config.ini over SFTP instead of sending CLI commands")
+    subcommands.add_parser('rotate', parents=[inventoryOptions, fleetOptions], help="only change the apc password of every UPS to upsNewPassword")
+    subcommands.add_parser('audit', parents=[inventoryOptions, fleetOptions], help="only read the configuration of every UPS as the service account and "
+        "store it in " + auditFile)
+    subcommands.add_parser('preflight', parents=[inventoryOptions], help="only check which UPSes answer as an NMC2 and write " + preflightFile)
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if len(argv) == 0 or (argv[0] not in subcommandCredentials and argv[0] not in ('-h', '--help')):
+        argv = ['rollout'] + argv
+    args = parser.parse_args(argv)
+    if args.command != 'preflight':
+        if args.workers < 1:
+            parser.error("--workers must be at least 1")
+        if args.per_site is not None and args.per_site < 1:
+            parser.error("--per-site must be at least 1")
+        if args.radius_rate <= 0:
+            parser.error("--radius-rate must be more than 0")
+        if args.retries < 0 or args.retry_delay < 0:
+            parser.error("--retries and --retry-delay can not be negative")
+        radiusLimit.configuredRate = radiusLimit.rate = args.radius_rate
+    try:
+        missing = loadCredentials(args.command, args.secrets_file)
+    except (OSError, ValueError) as error:
+        parser.error("could not read the secrets file: " + str(error))
+    if missing:
+        parser.error(args.command + " needs " + ", ".join(missing) + ", set them in the environment or in a secrets file given with --secrets-file")
+    try:
+        runSubcommand(args)
+    finally:
+        # Also write out what is still queued when the run fails, those are the lines that tell why
+        stopLogging()
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,561 @@
+import paramiko
+import argparse
+import logging
+import os
+import random
+import re
+import shlex
+import socket
+import threading
+import time
+
+"""
+
+A fake APC Network Management Card 2 for testing "ups configuration sanitized.py" without real hardware.
+
+Every simulated NMC listens for SSH on its own loopback address (127.0.1.1, 127.0.1.2, ...) and answers the parts of the NMC2 CLI that the
+configuration script uses:
+
+user -l, user -n <user> -cp <current> -pw <new>, user -del <user>
+radius, tcpip, ntp, system, smtp, email, snmpv3 (both showing and changing settings)
+prompt -s long|short
+
+A config.ini uploaded over SFTP is applied like the matching CLI commands, after which the card reboots once.
+
+A factory new card is simulated by default: the apc account uses the password apc and asks for a new password on the first login, and the device
+user still exists. The service account can log in once RADIUS has been pointed at a server with the right secret. Command latency, login latency
+and reboot time can be set, and the card reboots when a session that changed SNMP settings is closed. While rebooting the card accepts TCP
+connections on the SSH port but closes them without sending an SSH banner. With a drop chance set, the card closes the connection instead of answering
+that share of the commands, like a flaky uplink would.
+
+Run this script on its own to start a number of fake UPSes until Ctrl+C is pressed, or use it from "ups benchmark.py".
+
+Uses the loopback range 127.0.0.0/8, which answers on every address on Linux. On other platforms use a single address with different ports.
+
+"""
+
+hostKey = None
+hostKeyLock = threading.Lock()
+# Connections that are closed before the SSH handshake (like the readiness check in the configuration script) make paramiko log errors
+logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+# Which setting every option of every configuration command changes. Options followed by a number (email -g1, snmpv3 -ac2) change that
+# recipient, profile or access control entry
+commandOptions = {
+    'tcpip': {'-d': 'Domain Name', '-h': 'Host Name'},
+    'ntp': {'-e': 'NTP status', '-p': 'Primary NTP Server', '-s': 'Secondary NTP Server', '-u': None},
+    'system': {'-s': 'Host Name Sync', '-n': 'Name', '-c': 'Contact', '-l': 'Location'},
+    'smtp': {'-f': 'From', '-s': 'Server', '-p': 'Port'},
+    'email': {'-g': 'Generation', '-t': 'Address', '-o': 'Format', '-l': 'Language', '-r': 'Route'},
+    'snmpv3': {'-S': 'SNMPv3 Access', '-u': 'User Name', '-a': 'Authentication Passphrase', '-c': 'Privacy Passphrase', '-ap': 'Authentication',
+        '-pp': 'Encryption', '-ac': 'Access', '-au': 'Access User Name', '-n': 'NMS IP/Host Name'},
+    'radius': {'-a': 'Access', '-p1': 'Primary Server', '-o1': 'Primary Server Port', '-s1': 'Primary Server Secret', '-t1': 'Primary Server Timeout',
+        '-p2': 'Secondary Server', '-o2': 'Secondary Server Port', '-s2': 'Secondary Server Secret', '-t2': 'Secondary Server Timeout'},
+}
+# Which CLI option every config.ini key stands for, per section. A number at the end of the section (EmailRecipient1, SNMPv3AccessControl2) is
+# the recipient, profile or access control entry
+configIniOptions = {
+    'NetworkRADIUS': ('radius', {'Access': '-a', 'ServerPrimary': '-p1', 'PortPrimary': '-o1', 'SecretPrimary': '-s1', 'TimeoutPrimary': '-t1',
+        'ServerSecondary': '-p2', 'PortSecondary': '-o2', 'SecretSecondary': '-s2', 'TimeoutSecondary': '-t2'}),
+    'NetworkTCP/IP': ('tcpip', {'DomainName': '-d', 'HostName': '-h'}),
+    'SystemDate/Time': ('ntp', {'NTPEnable': '-e', 'NTPPrimaryServer': '-p', 'NTPSecondaryServer': '-s'}),
+    'SystemID': ('system', {'HostNameSync': '-s', 'Name': '-n', 'Contact': '-c', 'Location': '-l'}),
+    'NetworkSMTP': ('smtp', {'From': '-f', 'Server': '-s', 'Port': '-p'}),
+    'EmailRecipient': ('email', {'Generation': '-g', 'Address': '-t', 'Format': '-o', 'Language': '-l', 'Route': '-r'}),
+    'NetworkSNMP': ('snmpv3', {'SNMPv3Access': '-S'}),
+    'SNMPv3UserProfile': ('snmpv3', {'UserName': '-u', 'AuthPhrase': '-a', 'PrivPhrase': '-c', 'AuthProtocol': '-ap', 'PrivProtocol': '-pp'}),
+    'SNMPv3AccessControl': ('snmpv3', {'Access': '-ac', 'UserName': '-au', 'NMSHostIP': '-n'}),
+}
+# How the NMC shows values that are set with a short keyword
+displayValues = {'enable': 'enabled', 'disable': 'disabled', 'md5': 'MD5', 'sha': 'SHA', 'des': 'DES', 'aes': 'AES', 'enus': 'English',
+    'local': 'local', 'radiuslocal': 'RADIUS, then Local Authentication', 'radius': 'RADIUS Only'}
+
+def getHostKey():
+    """
+    One host key for every fake NMC, generating a key per NMC would only slow down starting them
+    """
+    global hostKey
+    with hostKeyLock:
+        if hostKey is None:
+            hostKey = paramiko.RSAKey.generate(2048)
+    return hostKey
+
+class FakeNMC:
+    """
+    The state of one simulated NMC2 and the SSH server in front of it
+    """
+    def __init__(self, address, port=22, serviceUsername="exampleServiceAccount", servicePassword="", radiusSecret="",
+            latency=0.05, loginLatency=0.3, rebootSeconds=5.0, rebootDelay=1.0, rebootOnDeviceDelete=False, dropChance=0.0, seed=None):
+        self.address = address
+        self.port = port
+        self.serviceUsername = serviceUsername
+        self.servicePassword = servicePassword
+        self.radiusSecret = radiusSecret
+        self.latency = latency
+        self.loginLatency = loginLatency
+        self.rebootSeconds = rebootSeconds
+        self.rebootDelay = rebootDelay
+        self.rebootOnDeviceDelete = rebootOnDeviceDelete
+        self.dropChance = dropChance
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.users = {'apc': 'apc', 'device': 'apc'}
+        self.passwordChangeRequired = True
+        self.rebootingUntil = 0.0
+        self.transports = []
+        self.listener = None
+        self.running = False
+        # Counters for the benchmark
+        self.logins = 0
+        self.failedLogins = 0
+        self.commands = 0
+        self.reboots = 0
+        self.configIniUploads = 0
+        self.radiusRequests = 0
+        self.droppedConnections = 0
+        self.settings = {
+            'tcpip': {'Domain Name': '', 'Host Name': 'apc' + address.replace('.', '')[-6:]},
+            'ntp': {'NTP status': 'disabled', 'Primary NTP Server': '0.0.0.0', 'Secondary NTP Server': '0.0.0.0'},
+            'system': {'Host Name Sync': 'disabled', 'Name': 'apc' + address.replace('.', '')[-6:], 'Contact': 'Unknown', 'Location': 'Unknown'},
+            'smtp': {'From': 'address@example.com', 'Server': '0.0.0.0', 'Port': '25'},
+            'email': dict((index, {'Generation': 'disabled', 'Address': '', 'Format': 'long', 'Language': 'English', 'Route': 'local'}) for index in '1234'),
+            'snmpv3': {'SNMPv3 Access': 'disabled',
+                'profiles': dict((index, {'User Name': 'apc snmp profile' + index, 'Authentication Passphrase': '', 'Privacy Passphrase': '',
+                    'Authentication': 'none', 'Encryption': 'none'}) for index in '1234'),
+                'access': dict((index, {'Access User Name': 'apc snmp profile' + index, 'Access': 'disabled', 'NMS IP/Host Name': '0.0.0.0'}) for index in '1234')},
+            'radius': {'Access': 'Local Only', 'Primary Server': '0.0.0.0', 'Primary Server Port': '1812', 'Primary Server Secret': '',
+                'Primary Server Timeout': '5', 'Secondary Server': '0.0.0.0', 'Secondary Server Port': '1812', 'Secondary Server Secret': '',
+                'Secondary Server Timeout': '5'},
+        }
+        self.promptLong = False
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.address, self.port))
+        self.listener.listen(50)
+        self.running = True
+        threading.Thread(target=self.acceptConnections, name='nmc ' + self.address, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.listener is not None:
+            self.listener.close()
+        self.dropSessions()
+
+    def rebooting(self):
+        return time.monotonic() < self.rebootingUntil
+
+    def reboot(self):
+        """
+        Drop every session and stop answering SSH for rebootSeconds
+        """
+        with self.lock:
+            self.rebootingUntil = time.monotonic() + self.rebootSeconds
+            self.reboots += 1
+        self.dropSessions()
+
+    def scheduleReboot(self):
+        timer = threading.Timer(self.rebootDelay, self.reboot)
+        timer.daemon = True
+        timer.start()
+
+    def dropSessions(self):
+        with self.lock:
+            transports = self.transports
+            self.transports = []
+        for transport in transports:
+            transport.close()
+
+    def acceptConnections(self):
+        while self.running:
+            try:
+                client, address = self.listener.accept()
+            except OSError:
+                return
+            if self.rebooting():
+                client.close()      # TCP still answers while the card boots, SSH does not
+                continue
+            threading.Thread(target=self.serveConnection, args=(client,), daemon=True).start()
+
+    def serveConnection(self, client):
+        transport = paramiko.Transport(client)
+        transport.local_version = "SSH-2.0-cryptlib"    # What an NMC2 announces itself as
+        transport.add_server_key(getHostKey())
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, NMCFiles, self)
+        server = NMCServer(self)
+        with self.lock:
+            self.transports.append(transport)
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(30)
+            if channel is None:
+                return
+            server.channelStarted.wait(10)
+            if server.subsystem:
+                # The SFTP server runs on its own thread, keep the connection open until the client is done with it
+                while transport.is_active() and not channel.closed:
+                    time.sleep(0.05)
+                return
+            NMCShell(self, channel, server.username).run()
+        except Exception:
+            pass
+        finally:
+            transport.close()
+            with self.lock:
+                if transport in self.transports:
+                    self.transports.remove(transport)
+
+    def authenticate(self, username, password):
+        time.sleep(self.loginLatency)
+        with self.lock:
+            if self.rebooting():
+                return False
+            if username in self.users and self.users[username] == password:
+                self.logins += 1
+                return True
+            radius = self.settings['radius']
+            if username == self.serviceUsername and radius['Access'] != 'Local Only':
+                self.radiusRequests += 1
+                if radius['Primary Server'] != '0.0.0.0' and radius['Primary Server Secret'] == self.radiusSecret and password == self.servicePassword:
+                    self.logins += 1
+                    return True
+            self.failedLogins += 1
+            return False
+
+    def dropConnection(self):
+        """
+        Whether the connection should be dropped instead of answering the next command
+        """
+        with self.lock:
+            if self.dropChance > 0 and self.random.random() < self.dropChance:
+                self.droppedConnections += 1
+                return True
+        return False
+
+    def runCommand(self, line, username, session):
+        """
+        Run one CLI command and return what the NMC prints in response, without the prompt
+        """
+        self.commands += 1
+        try:
+            words = shlex.split(line)
+        except ValueError:
+            return "E102: Parameter Error"
+        if len(words) == 0:
+            return None
+        command = words[0]
+        with self.lock:
+            if command == 'user':
+                return self.userCommand(words[1:], username, session)
+            if command == 'prompt':
+                if words[1:] == ['-s', 'long']:
+                    self.promptLong = True
+                elif words[1:] == ['-s', 'short']:
+                    self.promptLong = False
+                else:
+                    return "E102: Parameter Error"
+                return "E000: Success"
+            if command not in commandOptions:
+                return "E101: Command Not Found"
+            if len(words) == 1:
+                return "E000: Success\r\n" + self.showSettings(command)
+            return self.changeSettings(command, words[1:], session)
+
+    def userCommand(self, arguments, username, session):
+        if arguments == ['-l']:
+            return "E000: Success\r\n" + "\r\n".join("%-20s %s" % (user, 'Administrator' if user == 'apc' else 'Device User') for user in self.users)
+        if len(arguments) == 2 and arguments[0] == '-del':
+            if arguments[1] not in self.users or arguments[1] == 'apc':
+                return "E102: Parameter Error"
+            del self.users[arguments[1]]
+            if self.rebootOnDeviceDelete:
+                self.scheduleReboot()
+            return "E000: Success"
+        if len(arguments) == 6 and arguments[0] == '-n' and arguments[2] == '-cp' and arguments[4] == '-pw':
+            if arguments[1] not in self.users or self.users[arguments[1]] != arguments[3]:
+                return "E102: Parameter Error"
+            self.users[arguments[1]] = arguments[5]
+            if arguments[1] == username:
+                session['dropAfterReply'] = True     # Changing your own password ends the session
+            return "E000: Success"
+        return "E102: Parameter Error"
+
+    def changeSettings(self, command, arguments, session):
+        changes = []
+        while len(arguments) > 0:
+            option = arguments.pop(0)
+            match = re.match(r'^(-[A-Za-z]+)(\d*)$', option)
+            if match is None:
+                return "E102: Parameter Error"
+            if option in commandOptions[command]:
+                name, index = commandOptions[command][option], ''
+            elif match.group(1) in commandOptions[command]:
+                name, index = commandOptions[command][match.group(1)], match.group(2)
+            else:
+                return "E102: Parameter Error"
+            if name is None:
+                continue    # Actions like ntp -u that do not change anything
+            if len(arguments) == 0:
+                return "E102: Parameter Error"
+            value = arguments.pop(0)
+            changes.append((name, index, displayValues.get(value.lower(), value)))
+
+        for name, index, value in changes:
+            if command == 'email':
+                self.settings['email'].setdefault(index or '1', {})[name] = value
+            elif command == 'snmpv3':
+                if name == 'SNMPv3 Access':
+                    self.settings['snmpv3'][name] = value
+                elif name in ('Access User Name', 'Access', 'NMS IP/Host Name'):
+                    self.settings['snmpv3']['access'].setdefault(index or '1', {})[name] = value
+                else:
+                    self.settings['snmpv3']['profiles'].setdefault(index or '1', {})[name] = value
+            else:
+                self.settings[command][name] = value
+        if command == 'snmpv3' and len(changes) > 0:
+            # SNMP changes are applied when the session that made them ends
+            session['rebootOnClose'] = True
+            return "E002: Success\r\nReboot required for change to take effect."
+        return "E000: Success"
+
+    def applyConfigIni(self, text):
+        """
+        Apply an uploaded config.ini through the same code the CLI commands use, then reboot like a real card does
+        """
+        section = None
+        applied = 0
+        with self.lock:
+            for line in text.splitlines():
+                line = line.strip()
+                if line.startswith('[') and line.endswith(']'):
+                    section = line[1:-1]
+                    continue
+                if '=' not in line or section is None:
+                    continue
+                key, value = line.split('=', 1)
+                match = re.match(r'^(.*?)(\d*)$', section)
+                command, options = configIniOptions.get(match.group(1), (None, {}))
+                if key.strip() not in options:
+                    continue    # A real card notes unknown keys in its event log and carries on
+                option = options[key.strip()]
+                if match.group(2) != '' and not option[-1].isdigit():
+                    option += match.group(2)
+                if not self.changeSettings(command, [option, value.strip()], {}).startswith("E102"):
+                    applied += 1
+            self.configIniUploads += 1
+        if applied > 0:
+            self.scheduleReboot()
+
+    def showSettings(self, command):
+        hidden = ('Primary Server Secret', 'Secondary Server Secret', 'Authentication Passphrase', 'Privacy Passphrase')
+        lines = []
+        if command == 'tcpip':
+            lines += ["Active IPv4 Settings", "--------------------", "  Active IPv4 Address:      " + self.address,
+                "Manually Configured IPv4 Settings", "-----------------------------------"]
+        if command == 'email':
+            for index, recipient in sorted(self.settings['email'].items()):
+                lines.append("Recipient:     " + index)
+                lines += ["%-15s%s" % (name + ':', value) for name, value in recipient.items()]
+                lines.append("")
+        elif command == 'snmpv3':
+            snmp = self.settings['snmpv3']
+            lines += ["SNMPv3 Configuration", "SNMPv3 Access:           " + snmp['SNMPv3 Access'], "", "SNMPv3 User Profiles"]
+            for index, profile in sorted(snmp['profiles'].items()):
+                lines.append("Index:                   " + index)
+                lines += ["%-25s%s" % (name + ':', value) for name, value in profile.items() if name not in hidden]
+            lines += ["", "SNMPv3 Access Control"]
+            for index, access in sorted(snmp['access'].items()):
+                lines += ["Index:                   " + index, "User Name:               " + access['Access User Name'],
+                    "Access:                  " + access['Access'], "NMS IP/Host Name:        " + access['NMS IP/Host Name']]
+        else:
+            for name, value in self.settings[command].items():
+                lines.append("%-25s%s" % (name + ':', '<hidden>' if name in hidden else value))
+        if command == 'system':
+            lines.append("Up Time:                 0 Days 0 Hours 5 Minutes")
+        return "\r\n".join(lines)
+
+class NMCServer(paramiko.ServerInterface):
+    def __init__(self, nmc):
+        self.nmc = nmc
+        self.username = None
+        self.subsystem = None
+        self.channelStarted = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if self.nmc.authenticate(username, password):
+            self.username = username
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.channelStarted.set()
+        return True
+
+    def check_channel_subsystem_request(self, channel, name):
+        self.subsystem = name
+        self.channelStarted.set()
+        return paramiko.ServerInterface.check_channel_subsystem_request(self, channel, name)
+
+class NMCFiles(paramiko.SFTPServerInterface):
+    """
+    The file system of the card as far as SFTP goes: only config.ini can be written, and it is applied once the upload is closed
+    """
+    def __init__(self, server, nmc):
+        paramiko.SFTPServerInterface.__init__(self, server)
+        self.nmc = nmc
+
+    def open(self, path, flags, attr):
+        if path.lstrip('/') != 'config.ini' or not flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        return ConfigIniUpload(self.nmc, flags)
+
+class ConfigIniUpload(paramiko.SFTPHandle):
+    def __init__(self, nmc, flags):
+        paramiko.SFTPHandle.__init__(self, flags)
+        self.nmc = nmc
+        self.data = bytearray()
+
+    def write(self, offset, data):
+        self.data[offset:offset + len(data)] = data
+        return paramiko.SFTP_OK
+
+    def close(self):
+        paramiko.SFTPHandle.close(self)
+        self.nmc.applyConfigIni(self.data.decode('utf-8', 'replace'))
+
+class NMCShell:
+    """
+    The interactive CLI of one session: echoes what is typed, runs a command on every carriage return or line feed and prints the prompt
+    """
+    def __init__(self, nmc, channel, username):
+        self.nmc = nmc
+        self.channel = channel
+        self.username = username
+        self.session = {}
+
+    def prompt(self):
+        if self.nmc.promptLong:
+            return self.username + "@apc>"
+        return "apc>"
+
+    def readLine(self, echo=True):
+        line = ''
+        while True:
+            data = self.channel.recv(1024)
+            if not data:
+                raise EOFError
+            for character in data.decode('utf-8', 'replace').replace('\x00', ''):
+                if character == '\n' and self.lastCharacter == '\r':
+                    self.lastCharacter = character
+                    continue
+                self.lastCharacter = character
+                if character in '\r\n':
+                    self.channel.send("\r\n")
+                    return line
+                if echo:
+                    self.channel.send(character)
+                line += character
+
+    def run(self):
+        self.lastCharacter = ''
+        try:
+            if self.username == 'apc' and self.nmc.passwordChangeRequired:
+                self.changeFirstPassword()
+            self.channel.send("\r\nAmerican Power Conversion               Network Management Card AOS\r\n\r\n" + self.prompt())
+            while True:
+                line = self.readLine().strip()
+                if line in ('quit', 'exit', 'bye'):
+                    break
+                if line != '':
+                    time.sleep(self.nmc.latency)
+                    if self.nmc.dropConnection():
+                        break
+                    output = self.nmc.runCommand(line, self.username, self.session)
+                    self.channel.send(output + "\r\n")
+                    if self.session.pop('dropAfterReply', False):
+                        break
+                self.channel.send("\r\n" + self.prompt())
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.channel.close()
+            if self.session.get('rebootOnClose'):
+                self.nmc.scheduleReboot()
+
+    def changeFirstPassword(self):
+        while True:
+            self.channel.send("\r\nThe current password policy requires you to change your password.\r\nEnter current password: ")
+            if self.readLine(echo=False) != self.nmc.users['apc']:
+                self.channel.send("\r\nIncorrect password\r\n")
+                continue
+            self.channel.send("Enter new password: ")
+            newPassword = self.readLine(echo=False)
+            self.channel.send("Confirm new password: ")
+            if self.readLine(echo=False) == newPassword and newPassword != '':
+                with self.nmc.lock:
+                    self.nmc.users['apc'] = newPassword
+                    self.nmc.passwordChangeRequired = False
+                return
+            self.channel.send("\r\nPasswords do not match\r\n")
+
+def loopbackAddress(firstAddress, number):
+    """
+    The loopback address number places after firstAddress
+    """
+    first = [int(part) for part in firstAddress.split('.')]
+    value = (first[1] << 16) + (first[2] << 8) + first[3] + number
+    return "127.%d.%d.%d" % ((value >> 16) & 255, (value >> 8) & 255, value & 255)
+
+def startFleet(count, firstAddress="127.0.1.1", port=22, **options):
+    """
+    Start count fake NMCs on consecutive loopback addresses and return them
+    """
+    fleet = []
+    seed = options.pop('seed', None)
+    for number in range(count):
+        # Every card gets its own seed, so a seeded fleet drops the same connections every run
+        nmc = FakeNMC(loopbackAddress(firstAddress, number), port, seed=None if seed is None else seed + number, **options)
+        nmc.start()
+        fleet.append(nmc)
+    return fleet
+
+def main():
+    parser = argparse.ArgumentParser(description="Run fake APC NMC2 cards on loopback addresses until Ctrl+C is pressed")
+    parser.add_argument('--units', type=int, default=5, help="number of fake UPSes")
+    parser.add_argument('--first-address', default="127.0.1.1", help="loopback address of the first fake UPS")
+    parser.add_argument('--port', type=int, default=2222, help="SSH port every fake UPS listens on")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds every command takes")
+    parser.add_argument('--login-latency', type=float, default=0.3, help="seconds every login takes")
+    parser.add_argument('--reboot-seconds', type=float, default=5.0, help="seconds a reboot takes")
+    parser.add_argument('--service-password', default="", help="password the RADIUS service account is accepted with")
+    parser.add_argument('--radius-secret', default="", help="RADIUS secret the fake RADIUS server expects")
+    parser.add_argument('--drop-chance', type=float, default=0.0, help="chance that a command gets the connection dropped instead of an answer")
+    parser.add_argument('--seed', type=int, help="seed for the dropped connections")
+    args = parser.parse_args()
+
+    getHostKey()
+    fleet = startFleet(args.units, args.first_address, args.port, latency=args.latency, loginLatency=args.login_latency,
+        rebootSeconds=args.reboot_seconds, servicePassword=args.service_password, radiusSecret=args.radius_secret, dropChance=args.drop_chance,
+        seed=args.seed)
+    print("Started " + str(len(fleet)) + " fake UPSes on port " + str(args.port) + ": " + ", ".join(nmc.address for nmc in fleet))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for nmc in fleet:
+            nmc.stop()
+
+if __name__ == "__main__":
+    main()